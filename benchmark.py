@@ -0,0 +1,820 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import threading
+import itertools
+import subprocess
+import tracemalloc
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+import discord
+from audio import write_packed_opus, encode_packed_opus
+from monitoring import stats, resident_memory, format_bytes
+
+# Offline load test for bot2.py. Drives slash_play, slash_fav, the player
+# buttons (handle_action) and the now-playing embed (send_embed) of N guilds
+# with M listeners each, against local stand-ins for Discord and yt-dlp:
+#   python benchmark.py --guilds 50 --listeners 3 --duration 60
+# bot2 is imported from a scratch directory, so its caches, databases and
+# bot.log never touch the real ones.
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+FRAME_LENGTH = 0.02  # Seconds of audio per Opus frame, as discord.py sends them
+PACKET_SIZE = 320  # Bytes per synthetic Opus packet, about 128 kbit/s
+BASE_SNOWFLAKE_MS = 1_500_000_000_000  # Guild and user ids are minted from here
+
+# Discord's per-route limits as (requests, per seconds), keyed by route with
+# the major parameter that scopes the bucket
+ROUTES = {
+    "send": ("POST", "/channels/{channel_id}/messages", (5, 5)),
+    "edit": ("PATCH", "/channels/{channel_id}/messages/{message_id}", (5, 5)),
+    "delete": ("DELETE", "/channels/{channel_id}/messages/{message_id}", (5, 1)),
+    "bulk_delete": ("POST", "/channels/{channel_id}/messages/bulk-delete", (1, 1)),
+    "callback": ("POST", "/interactions/{interaction_id}/{interaction_token}/callback", None),
+    "followup": ("POST", "/webhooks/{application_id}/{interaction_token}", (5, 2)),
+    "delete_followup": ("DELETE", "/webhooks/{application_id}/{interaction_token}/messages/{message_id}", (5, 2)),
+}
+GLOBAL_LIMIT = (50, 1)  # Requests per second across all routes; interaction callbacks are exempt
+VOICE_STATE_LIMIT = (120, 60)  # Gateway sends per shard
+# Relative weights of what a listener does between tracks
+ACTIONS = {"skip": 3, "fav": 3, "resume": 2, "/play": 2, "stop": 1, "loop": 1, "prev": 1, "/fav": 1,
+           "/seek": 1, "/replay": 1}
+
+bot2 = None  # Imported once the scratch directory is in place
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def summarize(values):
+    return {"count": len(values), "p50": percentile(values, 0.5), "p95": percentile(values, 0.95),
+            "max": max(values) if values else 0.0}
+
+
+# Discord stand-ins
+class Bucket:
+    # Fixed window rate limit. Callers queue in order and sleep out the window
+    # once it is used up, the way discord.py waits on a route it knows is exhausted.
+    def __init__(self, limit, per):
+        self.limit = limit
+        self.per = per
+        self._remaining = limit
+        self._reset = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            now = time.monotonic()
+            if now >= self._reset:
+                self._remaining = self.limit
+                self._reset = now + self.per
+            waited = 0.0
+            if self._remaining <= 0:
+                waited = self._reset - now
+                await asyncio.sleep(waited)
+                self._remaining = self.limit
+                self._reset = time.monotonic() + self.per
+            self._remaining -= 1
+            return waited
+
+
+class FakeRest:
+    # REST layer: the global bucket, one bucket per route and major parameter,
+    # and a round trip per request. Timings go to the same stats series the
+    # bot's instrumented HTTP client feeds.
+    def __init__(self, rtt):
+        self.rtt = rtt
+        self.global_bucket = Bucket(*GLOBAL_LIMIT)
+        self.buckets = {}
+        self._snowflakes = itertools.count()
+
+    def snowflake(self):
+        base = discord.utils.time_snowflake(datetime.now(timezone.utc))
+        return base + next(self._snowflakes) % (1 << 22)
+
+    async def request(self, route, major):
+        method, path, limit = ROUTES[route]
+        started = time.perf_counter()
+        waited = 0.0
+        if limit is not None:
+            waited += await self.global_bucket.acquire()
+            bucket = self.buckets.get((route, major))
+            if bucket is None:
+                bucket = self.buckets[(route, major)] = Bucket(*limit)
+            waited += await bucket.acquire()
+        if waited:
+            stats.inc("rest_ratelimited_total", scope="route")
+            stats.observe("rest_ratelimit_wait_seconds", waited)
+        await asyncio.sleep(self.rtt)
+        stats.observe("rest_request_seconds", time.perf_counter() - started, method=method, route=path)
+
+    # The two HTTPClient calls purge_messages makes
+    async def delete_messages(self, channel_id, message_ids, reason=None):
+        await self.request("bulk_delete", channel_id)
+
+    async def delete_message(self, channel_id, message_id, reason=None):
+        await self.request("delete", channel_id)
+
+
+class FakeGateway:
+    # Voice connections: a voice state update on the guild's shard, limited
+    # per shard, then the voice server handshake
+    def __init__(self, shards, handshake):
+        self.shards = shards
+        self.handshake = handshake
+        self.buckets = [Bucket(*VOICE_STATE_LIMIT) for _ in range(shards)]
+
+    async def voice_state(self, guild):
+        await self.buckets[guild.shard_id].acquire()
+
+    async def connect(self, channel, harness):
+        await self.voice_state(channel.guild)
+        await asyncio.sleep(self.handshake)
+        return FakeVoiceClient(channel, harness)
+
+
+class FakeMessage:
+    def __init__(self, rest, channel, content=None, embed=None):
+        self._rest = rest
+        self.id = rest.snowflake()
+        self.channel = channel
+        self.guild = channel.guild
+        self.content = content
+        self.embed = embed
+
+    async def edit(self, *, content=None, embed=None, view=None):
+        await self._rest.request("edit", self.channel.id)
+        self.content = content or self.content
+        self.embed = embed or self.embed
+
+    async def delete(self):
+        await self._rest.request("delete", self.channel.id)
+
+
+class FakeWebhookMessage(discord.WebhookMessage):
+    # An ephemeral followup; the notifier tells them apart from channel
+    # messages by type, so this has to be a WebhookMessage
+    def __init__(self, rest, token):
+        self._rest = rest
+        self._token = token
+        self.id = rest.snowflake()
+
+    async def delete(self, *, delay=None):
+        await self._rest.request("delete_followup", self._token)
+
+
+class FakeTextChannel:
+    def __init__(self, rest, guild, channel_id):
+        self._rest = rest
+        self.guild = guild
+        self.id = channel_id
+        self.name = f"music-{guild.index}"
+
+    def permissions_for(self, member):
+        return discord.Permissions.all()
+
+    async def send(self, content=None, *, embed=None, view=None):
+        await self._rest.request("send", self.id)
+        return FakeMessage(self._rest, self, content, embed)
+
+    async def delete_messages(self, messages):
+        if len(messages) == 1:
+            await messages[0].delete()
+        else:
+            await self._rest.request("bulk_delete", self.id)
+
+
+class FakeVoiceChannel:
+    def __init__(self, harness, guild, channel_id):
+        self._harness = harness
+        self.guild = guild
+        self.id = channel_id
+        self.name = f"voice-{guild.index}"
+
+    @property
+    def members(self):
+        return self.guild.listeners
+
+    def permissions_for(self, member):
+        return discord.Permissions.all()
+
+    async def connect(self, **kwargs):
+        return await self._harness.gateway.connect(self, self._harness)
+
+
+class FakeMember:
+    def __init__(self, member_id, name, guild, voice_channel=None, bot=False):
+        self.id = member_id
+        self.name = self.display_name = name
+        self.guild = guild
+        self.bot = bot
+        self.voice = FakeVoiceState(voice_channel) if voice_channel is not None else None
+
+
+class FakeVoiceState:
+    def __init__(self, channel):
+        self.channel = channel
+
+
+class FakeGuild:
+    def __init__(self, harness, index):
+        self.index = index
+        snowflake_ms = BASE_SNOWFLAKE_MS + index
+        self.id = snowflake_ms << 22
+        self.shard_id = snowflake_ms % harness.gateway.shards
+        self.name = f"Benchmark guild {index}"
+        self.me = FakeMember(harness.bot_id, "musicbot", self, bot=True)
+        self.text_channel = FakeTextChannel(harness.rest, self, self.id + 1)
+        self.voice_channel = FakeVoiceChannel(harness, self, self.id + 2)
+        self.listeners = [FakeMember(self.id + 100 + idx, f"listener-{index}-{idx}", self, self.voice_channel)
+                          for idx in range(harness.args.listeners)]
+        self.members = self.listeners
+        self.play_requested = None  # When the first /play came in, for time to first audio
+
+    def get_channel(self, channel_id):
+        return {self.text_channel.id: self.text_channel, self.voice_channel.id: self.voice_channel}.get(channel_id)
+
+
+class FakeInteractionResponse:
+    def __init__(self, interaction):
+        self._interaction = interaction
+        self._done = False
+
+    def is_done(self):
+        return self._done
+
+    async def _respond(self):
+        if self._done:
+            raise discord.InteractionResponded(self._interaction)
+        self._done = True
+        await self._interaction._rest.request("callback", self._interaction.id)
+
+    async def defer(self, *, ephemeral=False, thinking=False):
+        await self._respond()
+
+    async def send_message(self, content=None, *, ephemeral=False, **kwargs):
+        await self._respond()
+
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self._interaction = interaction
+
+    async def send(self, content=None, *, ephemeral=False, **kwargs):
+        rest = self._interaction._rest
+        await rest.request("followup", self._interaction.token)
+        return FakeWebhookMessage(rest, self._interaction.token)
+
+
+class FakeInteraction:
+    def __init__(self, rest, guild, user, command=None, message=None):
+        self._rest = rest
+        self.id = rest.snowflake()
+        self.token = f"token-{self.id}"
+        self.guild = guild
+        self.guild_id = guild.id
+        self.user = user
+        self.channel = guild.text_channel
+        self.message = message
+        self.command = argparse.Namespace(name=command) if command else None
+        self.response = FakeInteractionResponse(self)
+        self.followup = FakeFollowup(self)
+
+
+# Voice stand-in
+class FakeAudioPlayer(threading.Thread):
+    # Mirrors discord.py's AudioPlayer: one read() per 20 ms frame on its own
+    # thread, sleeping out the rest of each frame, then cleanup and the after
+    # callback. Frames that arrive too late to keep the pace are counted.
+    def __init__(self, client, source, after):
+        super().__init__(name=f"fake-voice-{client.channel.guild.index}", daemon=True)
+        self.client = client
+        self.source = source
+        self.after = after
+        self.frames = 0
+        self.late_frames = 0
+        self.cpu = 0.0
+        self._end = threading.Event()
+        self._resumed = threading.Event()
+        self._resumed.set()
+
+    def run(self):
+        error = None
+        try:
+            self._play()
+        except Exception as e:
+            error = e
+        finally:
+            self._end.set()
+            self.source.cleanup()
+            self.client._finished(self)
+        if self.after is not None:
+            self.after(error)
+
+    def _play(self):
+        start = time.perf_counter()
+        loops = 0
+        while not self._end.is_set():
+            if not self._resumed.is_set():
+                self._resumed.wait()
+                start = time.perf_counter()
+                loops = 0
+                continue
+            cpu_started = time.thread_time()
+            packet = self.source.read()
+            self.cpu += time.thread_time() - cpu_started
+            if not packet:
+                return
+            if self.frames == 0:
+                self.client._first_frame()
+            self.frames += 1
+            loops += 1
+            delay = FRAME_LENGTH + start + FRAME_LENGTH * loops - time.perf_counter()
+            if delay < 0:
+                self.late_frames += 1
+            time.sleep(max(0.0, delay))
+
+    def is_playing(self):
+        return self._resumed.is_set() and not self._end.is_set()
+
+    def is_paused(self):
+        return not self._resumed.is_set() and not self._end.is_set()
+
+    def pause(self):
+        self._resumed.clear()
+
+    def resume(self):
+        self._resumed.set()
+
+    def set_source(self, source):
+        self.source = source
+        self.resume()
+
+    def stop(self):
+        self._end.set()
+        self._resumed.set()
+
+
+class FakeVoiceClient:
+    # Enough of discord.VoiceClient for MusicPlayer, recording the gap
+    # between one track ending and the next one starting
+    def __init__(self, channel, harness):
+        self.channel = channel
+        self._harness = harness
+        self._connected = True
+        self._player = None
+        self._ended_at = None
+
+    @property
+    def source(self):
+        return self._player.source if self._player is not None else None
+
+    @source.setter
+    def source(self, value):
+        if self._player is None:
+            raise ValueError("Not playing anything.")
+        self._player.set_source(value)
+
+    def is_connected(self):
+        return self._connected
+
+    def is_playing(self):
+        return self._player is not None and self._player.is_playing()
+
+    def is_paused(self):
+        return self._player is not None and self._player.is_paused()
+
+    def play(self, source, *, after=None, **kwargs):
+        if not self._connected:
+            raise discord.ClientException("Not connected to voice.")
+        if self.is_playing() or self.is_paused():
+            raise discord.ClientException("Already playing audio.")
+        if self._ended_at is not None:
+            self._harness.gaps.append(time.monotonic() - self._ended_at)
+            self._ended_at = None
+        self._player = FakeAudioPlayer(self, source, after)
+        self._player.start()
+
+    def pause(self):
+        if self._player is not None:
+            self._player.pause()
+
+    def resume(self):
+        if self._player is not None:
+            self._player.resume()
+
+    def stop(self):
+        if self._player is not None:
+            self._player.stop()
+
+    async def disconnect(self, *, force=False):
+        if not self._connected:
+            return
+        self._connected = False
+        self.stop()
+        await self._harness.gateway.voice_state(self.channel.guild)
+
+    def _first_frame(self):
+        guild = self.channel.guild
+        if guild.play_requested is not None:
+            self._harness.time_to_audio.append(time.monotonic() - guild.play_requested)
+            guild.play_requested = None
+
+    def _finished(self, player):
+        # Player thread
+        self._harness.record_stream(player)
+        if self._connected:
+            self._ended_at = time.monotonic()
+
+
+# yt-dlp stand-in
+class StubExtractor:
+    # Replaces the three functions of bot2 that call yt-dlp. Searches and
+    # stream lookups sleep for the configured latency on the extraction
+    # threads, as yt-dlp blocks them; downloads fill the cache from local files.
+    def __init__(self, harness, catalogue, latency, media_url):
+        self.harness = harness
+        self.catalogue = catalogue
+        self.latency = latency
+        self.media_url = media_url
+
+    def _wait(self):
+        time.sleep(self.latency * random.uniform(0.5, 1.5))
+
+    def entry(self, idx):
+        video_id = f"bench{idx:05d}"
+        return {"id": video_id, "title": f"Benchmark track {idx}", "url": f"https://bench.invalid/watch?v={video_id}",
+                "webpage_url": f"https://bench.invalid/watch?v={video_id}", "duration": self.harness.args.track_seconds,
+                "extractor_key": "Bench", "ie_key": "Bench"}
+
+    def extract_batches(self, query, opts, batch_size, emit, stop):
+        # "playlist:<guild>" gives that guild's playlist, "track:<n>" one catalogue entry
+        kind, _, arg = query.partition(":")
+        if kind == "playlist":
+            rng = random.Random(int(arg))
+            indexes = [rng.randrange(len(self.catalogue)) for _ in range(self.harness.args.playlist_size)]
+        else:
+            indexes = [int(arg) % len(self.catalogue)]
+        batch = []
+        for position, idx in enumerate(indexes):
+            # yt-dlp fetches playlists a page of 100 entries at a time
+            if position % 100 == 0:
+                self._wait()
+            if stop.is_set():
+                return
+            batch.append(bot2.Track.from_entry(self.entry(idx)))
+            if len(batch) >= (1 if position == 0 else batch_size):
+                emit(batch)
+                batch = []
+        if batch:
+            emit(batch)
+
+    def extract_stream(self, url):
+        self._wait()
+        video_id = url.rsplit("=", 1)[-1]
+        entry = self.entry(int(video_id[len("bench"):]))
+        expire = int(time.time()) + 6 * 3600
+        return {"url": f"{self.media_url}/{video_id}{self.catalogue.suffix}?expire={expire}", "id": video_id,
+                "extractor_key": "Bench", "acodec": "opus", "duration": entry["duration"],
+                "webpage_url": entry["webpage_url"]}
+
+    def download_to_cache(self, url, key):
+        self._wait()
+        video_id = url.rsplit("=", 1)[-1]
+        temp_path = bot2.audio_cache.temp_path(key)
+        try:
+            self.catalogue.pack(video_id, temp_path)
+            return bot2.audio_cache.commit(key, temp_path, "opf")
+        except BaseException:
+            bot2.audio_cache.discard(temp_path)
+            raise
+
+
+class Catalogue:
+    # The local audio the stub extractor serves. Without FFmpeg every track is
+    # synthetic packed Opus and the audio cache starts warm; with FFmpeg tracks
+    # are real Ogg/Opus files streamed over local HTTP and the cache starts cold.
+    def __init__(self, directory, size, seconds, ffmpeg=None):
+        self.directory = directory
+        self.size = size
+        self.ffmpeg = ffmpeg
+        self.suffix = ".ogg" if ffmpeg else ".opf"
+        os.makedirs(directory, exist_ok=True)
+        self.template = os.path.join(directory, "template" + self.suffix)
+        if ffmpeg:
+            subprocess.run([ffmpeg, "-nostdin", "-loglevel", "error", "-f", "lavfi", "-i",
+                            f"sine=frequency=440:duration={seconds}", "-c:a", "libopus", "-b:a", "128k",
+                            "-ar", "48000", "-ac", "2", "-y", self.template], check=True)
+        else:
+            packet = b"\xfc" + os.urandom(PACKET_SIZE - 1)
+            write_packed_opus(itertools.repeat(packet, int(seconds / FRAME_LENGTH)), self.template)
+
+    def __len__(self):
+        return self.size
+
+    def path(self, video_id):
+        return self.template
+
+    def pack(self, video_id, dest_path):
+        if self.ffmpeg:
+            encode_packed_opus(self.ffmpeg, self.path(video_id), dest_path, copy=True)
+        else:
+            shutil.copyfile(self.path(video_id), dest_path)
+
+
+class MediaServer:
+    # Serves the catalogue over HTTP, so FFmpeg streams it with the bot's usual
+    # reconnect options; every track id maps to the same file
+    def __init__(self, catalogue):
+        catalogue_dir = catalogue.directory
+        template = os.path.basename(catalogue.template)
+
+        class Handler(SimpleHTTPRequestHandler):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, directory=catalogue_dir, **kwargs)
+
+            def translate_path(self, path):
+                return os.path.join(catalogue_dir, template)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, name="bench-media", daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+
+# Load generation
+class Harness:
+    def __init__(self, args, catalogue):
+        self.args = args
+        self.catalogue = catalogue
+        self.rng = random.Random(args.seed)
+        self.rest = FakeRest(args.rtt)
+        self.gateway = FakeGateway(args.shards, args.handshake)
+        self.bot_id = (BASE_SNOWFLAKE_MS << 22) + 1
+        self.latencies = {}
+        self.gaps = []
+        self.time_to_audio = []
+        self.streams = []
+        self._streams_lock = threading.Lock()
+        self.peak_rss = 0
+        self.peak_traced = 0
+        self.guilds = []
+
+    def record_stream(self, player):
+        with self._streams_lock:
+            self.streams.append((player.frames, player.late_frames, player.cpu))
+
+    async def command(self, name, command, guild, user, *args):
+        interaction = FakeInteraction(self.rest, guild, user, command=name.lstrip("/"))
+        started = time.perf_counter()
+        await command.callback(interaction, *args)
+        self.latencies.setdefault(name, []).append(time.perf_counter() - started)
+
+    async def press(self, guild, user, action):
+        player = bot2.music_players.get(guild.id)
+        if player is None or player.message is None:
+            return
+        interaction = FakeInteraction(self.rest, guild, user, message=player.message)
+        started = time.perf_counter()
+        await bot2.player_controls.press(action, interaction)
+        self.latencies.setdefault(f"button:{action}", []).append(time.perf_counter() - started)
+
+    async def run_guild(self, guild, deadline):
+        owner = guild.listeners[0]
+        guild.play_requested = time.monotonic()
+        await self.command("/play", bot2.slash_play, guild, owner, f"playlist:{self.args.seed * 100_000 + guild.index}")
+        # The other listeners queue a track each at the same moment
+        await asyncio.gather(*(self.command("/play", bot2.slash_play, guild, user,
+                                            f"track:{self.rng.randrange(self.args.catalogue)}")
+                               for user in guild.listeners[1:]))
+        actions, weights = zip(*ACTIONS.items())
+        while True:
+            pause = self.rng.expovariate(1 / self.args.action_interval)
+            if time.monotonic() + pause >= deadline:
+                break
+            await asyncio.sleep(pause)
+            user = self.rng.choice(guild.listeners)
+            action = self.rng.choices(actions, weights)[0]
+            if action == "/play":
+                await self.command("/play", bot2.slash_play, guild, user, f"track:{self.rng.randrange(self.args.catalogue)}")
+            elif action == "/fav":
+                await self.command("/fav", bot2.slash_fav, guild, user)
+            elif action == "/seek":
+                position = self.rng.uniform(0, self.args.track_seconds * 0.9)
+                await self.command("/seek", bot2.slash_seek, guild, user, f"{position:.1f}")
+            elif action == "/replay":
+                await self.command("/replay", bot2.slash_replay, guild, user)
+            else:
+                await self.press(guild, user, action)
+        await asyncio.sleep(max(0.0, deadline - time.monotonic()))
+        await self.press(guild, owner, "exit")
+
+    async def sample_memory(self):
+        while True:
+            self.peak_rss = max(self.peak_rss, resident_memory() or 0)
+            if tracemalloc.is_tracing():
+                self.peak_traced = max(self.peak_traced, tracemalloc.get_traced_memory()[0])
+            await asyncio.sleep(0.5)
+
+    async def run(self, media_url):
+        args = self.args
+        stub = StubExtractor(self, self.catalogue, args.extract_latency, media_url)
+        bot2._extract_batches = stub.extract_batches
+        bot2._extract_stream = stub.extract_stream
+        bot2._download_to_cache = stub.download_to_cache
+        bot2.bot.http.delete_messages = self.rest.delete_messages
+        bot2.bot.http.delete_message = self.rest.delete_message
+        if args.ffmpeg:
+            bot2.FFMPEG_EXECUTABLE = args.ffmpeg
+        else:
+            # No FFmpeg to stream with, so every track is in the cache up front
+            for idx in range(len(self.catalogue)):
+                entry = stub.entry(idx)
+                key = bot2.AudioCache.key_for(entry["extractor_key"], entry["id"])
+                temp_path = bot2.audio_cache.temp_path(key)
+                self.catalogue.pack(entry["id"], temp_path)
+                bot2.audio_cache.commit(key, temp_path, "opf")
+
+        bot2.loop_monitor.start()
+        bot2.player_controls = bot2.PlayerControls()
+        await bot2.favorites_store.open()
+        await bot2.message_ledger.open()
+        if bot2.voice_pool is not None:
+            await asyncio.get_running_loop().run_in_executor(None, bot2.voice_pool.start)
+        bot2.spawn_background(bot2.checkpoint_positions())
+        bot2.spawn_background(bot2.reap_idle_players())
+
+        self.guilds = [FakeGuild(self, idx) for idx in range(args.guilds)]
+        if args.tracemalloc:
+            tracemalloc.start()
+        baseline_rss = resident_memory() or 0
+        baseline_traced = tracemalloc.get_traced_memory()[0] if args.tracemalloc else 0
+        sampler = asyncio.create_task(self.sample_memory())
+        cpu_started = os.times()
+        started = time.monotonic()
+        deadline = started + args.ramp + args.duration
+        tasks = []
+        for guild in self.guilds:
+            tasks.append(asyncio.create_task(self.run_guild(guild, deadline)))
+            await asyncio.sleep(args.ramp / args.guilds)
+        await asyncio.gather(*tasks)
+        # Let the last after callbacks, embed edits and deletes settle
+        await asyncio.sleep(bot2.EMBED_DEBOUNCE + bot2.NOTICE_TTL + 2 * bot2.EXPIRY_TICK)
+        elapsed = time.monotonic() - started
+        cpu_finished = os.times()
+        sampler.cancel()
+        await bot2.queue_journal.flush()
+        await bot2.favorites_store.flush()
+        if bot2.voice_pool is not None:
+            bot2.voice_pool.stop()
+        return self.report(elapsed, cpu_started, cpu_finished, baseline_rss, baseline_traced)
+
+    def report(self, elapsed, cpu_started, cpu_finished, baseline_rss, baseline_traced):
+        args = self.args
+        snapshot = stats.snapshot()
+        frames = sum(stream[0] for stream in self.streams)
+        stream_seconds = frames * FRAME_LENGTH
+        process_cpu = (cpu_finished.user + cpu_finished.system) - (cpu_started.user + cpu_started.system)
+        children_cpu = ((cpu_finished.children_user + cpu_finished.children_system)
+                        - (cpu_started.children_user + cpu_started.children_system))
+        rest = {}
+        for (name, labels), summary in snapshot["histograms"].items():
+            if name == "rest_request_seconds":
+                labels = dict(labels)
+                rest[f"{labels['method']} {labels['route']}"] = summary
+        return {
+            "config": {key: value for key, value in vars(args).items() if key != "json"},
+            "elapsed_seconds": elapsed,
+            "commands": {name: summarize(values) for name, values in sorted(self.latencies.items())},
+            "time_to_first_audio": summarize(self.time_to_audio),
+            "track_gap": summarize(self.gaps),
+            "streams": {
+                "tracks": len(self.streams),
+                "stream_seconds": stream_seconds,
+                "late_frames": sum(stream[1] for stream in self.streams),
+                # Seconds of CPU per second of audio, i.e. the share of a core one stream costs
+                "player_thread_cpu": sum(stream[2] for stream in self.streams) / stream_seconds if frames else 0.0,
+                "process_cpu": process_cpu / stream_seconds if frames else 0.0,
+                "ffmpeg_cpu": children_cpu / stream_seconds if frames else 0.0,
+            },
+            "memory": {
+                "baseline_rss": baseline_rss,
+                "peak_rss": self.peak_rss,
+                "rss_per_guild": max(self.peak_rss - baseline_rss, 0) / args.guilds,
+                "traced_per_guild": max(self.peak_traced - baseline_traced, 0) / args.guilds if args.tracemalloc else None,
+            },
+            "rest": rest,
+            "rest_ratelimited": sum(value for (name, _), value in snapshot["counters"].items()
+                                    if name == "rest_ratelimited_total"),
+            "loop_lag": next((summary for (name, _), summary in snapshot["histograms"].items()
+                              if name == "loop_lag_seconds"), None),
+            "loop_stalls": sum(value for (name, _), value in snapshot["counters"].items() if name == "loop_stalls_total"),
+            "track_failures": {dict(labels)["reason"]: value for (name, labels), value in snapshot["counters"].items()
+                               if name == "track_failures_total"},
+        }
+
+
+def print_report(report):
+    config = report["config"]
+    ms = lambda seconds: f"{seconds * 1000:8.0f}"
+    print(f"{config['guilds']} guilds x {config['listeners']} listeners, {report['elapsed_seconds']:.0f} s, "
+          f"{'FFmpeg streaming, cold cache' if config['ffmpeg'] else 'warm cache'}, "
+          f"extract latency {config['extract_latency'] * 1000:.0f} ms, REST RTT {config['rtt'] * 1000:.0f} ms")
+    print()
+    print(f"{'latency (ms)':<28}{'count':>8}{'p50':>8}{'p95':>8}{'max':>8}")
+    rows = list(report["commands"].items()) + [("time to first audio", report["time_to_first_audio"]),
+                                               ("inter-track gap", report["track_gap"])]
+    for name, summary in rows:
+        print(f"{name:<28}{summary['count']:>8}{ms(summary['p50'])}{ms(summary['p95'])}{ms(summary['max'])}")
+    streams = report["streams"]
+    print()
+    print(f"Streams: {streams['tracks']} tracks, {streams['stream_seconds']:.0f} s of audio, "
+          f"{streams['late_frames']} late frames")
+    print(f"CPU per stream: player thread {streams['player_thread_cpu'] * 100:.2f}% of a core, "
+          f"whole process {streams['process_cpu'] * 100:.2f}%, FFmpeg {streams['ffmpeg_cpu'] * 100:.2f}%")
+    memory = report["memory"]
+    line = (f"Memory: baseline {format_bytes(memory['baseline_rss'])}, peak {format_bytes(memory['peak_rss'])}, "
+            f"{format_bytes(memory['rss_per_guild'])} RSS per guild")
+    if memory["traced_per_guild"] is not None:
+        line += f", {format_bytes(memory['traced_per_guild'])} Python heap per guild"
+    print(line)
+    lag = report["loop_lag"]
+    if lag:
+        print(f"Event loop lag: p50≤{lag['p50'] * 1000:.0f} ms p99≤{lag['p99'] * 1000:.0f} ms "
+              f"max {lag['max'] * 1000:.0f} ms, {report['loop_stalls']} stalls")
+    if report["track_failures"]:
+        print(f"Track failures: {report['track_failures']}")
+    print()
+    width = max([len(route) for route in report["rest"]] + [len("REST route")]) + 2
+    print(f"{'REST route':<{width}}{'calls':>7}{'mean':>8}{'max':>8}")
+    for route, summary in sorted(report["rest"].items()):
+        print(f"{route:<{width}}{summary['count']:>7}{ms(summary['mean'])}{ms(summary['max'])}")
+    print(f"Requests held back by rate limits: {report['rest_ratelimited']}")
+
+
+def main():
+    global bot2
+    parser = argparse.ArgumentParser(description="Offline load test for bot2.py")
+    parser.add_argument("--guilds", type=int, default=20, help="Guilds playing at once")
+    parser.add_argument("--listeners", type=int, default=3, help="Listeners per guild issuing commands")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds of load after the ramp")
+    parser.add_argument("--ramp", type=float, default=5, help="Seconds over which guilds start")
+    parser.add_argument("--action-interval", type=float, default=8, help="Mean seconds between a guild's actions")
+    parser.add_argument("--playlist-size", type=int, default=50, help="Entries in each guild's opening playlist")
+    parser.add_argument("--catalogue", type=int, default=40, help="Distinct tracks the stub extractor knows")
+    parser.add_argument("--track-seconds", type=float, default=15, help="Length of every track")
+    parser.add_argument("--extract-latency", type=float, default=0.5, help="Mean seconds per stub extraction")
+    parser.add_argument("--rtt", type=float, default=0.08, help="Seconds per fake REST round trip")
+    parser.add_argument("--handshake", type=float, default=0.3, help="Seconds per fake voice connection")
+    parser.add_argument("--shards", type=int, default=1, help="Shards the guilds are spread over")
+    parser.add_argument("--ffmpeg", help="FFmpeg executable; streams real audio with a cold cache")
+    parser.add_argument("--tracemalloc", action="store_true", help="Also measure Python heap per guild (slower)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch directory with bot.log")
+    parser.add_argument("--json", help="Also write the report to this file")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.json) if args.json else None
+    workdir = tempfile.mkdtemp(prefix="musicbot-bench-")
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    import bot2 as module
+    bot2 = module
+    random.seed(args.seed)
+
+    catalogue = Catalogue(os.path.join(workdir, "media"), args.catalogue, args.track_seconds, args.ffmpeg)
+    harness = Harness(args, catalogue)
+    media = MediaServer(catalogue) if args.ffmpeg else None
+    try:
+        report = asyncio.run(harness.run(media.url if media else "https://bench.invalid/media"))
+    finally:
+        if media is not None:
+            media.stop()
+        os.chdir(REPO_DIR)
+        if args.keep:
+            print(f"Scratch directory: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    print_report(report)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
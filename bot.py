@@ -47,9 +47,7 @@ class MusicPlayer:
         if not self.queue:
             # ไม่มีเพลงถัดไป → เก็บ current เหมือนเดิม
             if self.message:
-                msg = await self.text_channel.send("❌ No more songs in the queue.")
-                await asyncio.sleep(5)
-                await msg.delete()
+                await self.text_channel.send("❌ No more songs in the queue.", delete_after=5)
             return
 
         # มีเพลงถัดไป → เก็บเพลงก่อนหน้าไว้
@@ -135,15 +133,13 @@ async def slash_play(interaction: discord.Interaction, query: str):
     if not player.voice_client.is_playing() and not player.voice_client.is_paused():
         await player.play_next()
         msg = await interaction.followup.send(f"▶️ Playing: {results[0]['title']}", ephemeral=True)
-        asyncio.sleep(5)
-        await msg.delete()
+        await msg.delete(delay=5)
     elif player.voice_client.is_paused():
         player.voice_client.resume()
         await interaction.followup.send("▶️ Resumed playback.", ephemeral=True)
     else:
         msg = await interaction.followup.send(f"🎶 Added to queue: {results[0]['title']}", ephemeral=True)
-        asyncio.sleep(10)
-        await msg.delete()
+        await msg.delete(delay=10)
     
     # อัพเดต embed หลังจากเพิ่มเพลงเข้าคิว
     await player.send_embed()
@@ -189,9 +185,7 @@ async def handle_action(action, player, user, message):
     elif action == "resume":
         if player.voice_client.is_paused():
             player.voice_client.resume()
-            msg = await player.text_channel.send("▶️ Resumed playback.")
-            await asyncio.sleep(5)
-            await msg.delete()
+            await player.text_channel.send("▶️ Resumed playback.", delete_after=5)
         elif not player.voice_client.is_playing():
             await player.play_next()  # ถ้าไม่ได้ pause แต่ไม่มีเพลงเล่น → เล่นถัดไป
             
@@ -199,13 +193,9 @@ async def handle_action(action, player, user, message):
         if player.voice_client.is_playing():
             player.voice_client.pause()
             await player.send_embed()
-            msg = await player.text_channel.send("⏹️ Stopped playback.")
-            await asyncio.sleep(5)
-            await msg.delete()
+            await player.text_channel.send("⏹️ Stopped playback.", delete_after=5)
         else:
-            msg = await player.text_channel.send("⏹️ No currently song playing.")
-            await asyncio.sleep(5)
-            await msg.delete()
+            await player.text_channel.send("⏹️ No currently song playing.", delete_after=5)
             
     elif action == "skip":
         player.voice_client.stop()
@@ -215,58 +205,43 @@ async def handle_action(action, player, user, message):
         await player.send_embed()  # อัปเดต embed แสดง loop ใหม่
         
     elif action == "fav":
-        msg = await player.text_channel.send(f"⭐ Favorite: {player.current['title']}")
-        await asyncio.sleep(5)
-        await msg.delete()
+        await player.text_channel.send(f"⭐ Favorite: {player.current['title']}", delete_after=5)
         
     elif action == "exit":
         await player.voice_client.disconnect()
         music_players.pop(player.guild.id, None)
-        msg = await player.text_channel.send("❌ Bot exited voice channel.")
-        await asyncio.sleep(5)
-        await msg.delete()
-        for guild in bot.guilds:
-            for channel in guild.text_channels:
-                if not channel.permissions_for(guild.me).read_message_history:
-                    continue  # ข้ามถ้าไม่มีสิทธิ์อ่านประวัติ
-                if not channel.permissions_for(guild.me).manage_messages:
-                    continue  # ข้ามถ้าไม่มีสิทธิ์ลบข้อความ
-                try:
-                    async for msg in channel.history(limit=50):
-                        if msg.author.id == bot.user.id:
-                            await msg.delete()
-                except discord.Forbidden:
-                    print(f"❌ ไม่มีสิทธิ์ลบในห้อง {channel.name} ({channel.id})")
-                except discord.HTTPException as e:
-                    print(f"⚠️ ลบข้อความไม่สำเร็จ: {e}")
+        # Purge first so the exit notice itself stays up for its 5 seconds
+        await purge_bot_messages(player.text_channel)
+        await player.text_channel.send("❌ Bot exited voice channel.", delete_after=5)
+
+async def purge_bot_messages(channel, limit=50):
+    # channel.purge bulk deletes up to 100 messages per request
+    if not channel.permissions_for(channel.guild.me).read_message_history:
+        return  # ข้ามถ้าไม่มีสิทธิ์อ่านประวัติ
+    if not channel.permissions_for(channel.guild.me).manage_messages:
+        return  # ข้ามถ้าไม่มีสิทธิ์ลบข้อความ
+    try:
+        await channel.purge(limit=limit, check=lambda m: m.author.id == bot.user.id)
+    except discord.Forbidden:
+        print(f"❌ ไม่มีสิทธิ์ลบในห้อง {channel.name} ({channel.id})")
+    except discord.HTTPException as e:
+        print(f"⚠️ ลบข้อความไม่สำเร็จ: {e}")
 
 # ✅ Ready
+commands_synced = False
+
 @bot.event
 async def on_ready():
-    await tree.sync()
-    print(f"✅ {bot.user} is ready and commands are synced.".encode('ascii', 'ignore').decode())
+    global commands_synced
+    print(f"✅ {bot.user} is ready.".encode('ascii', 'ignore').decode())
     print(f"Connected to {len(bot.guilds)} guilds.")
-    
-@bot.event
-async def on_ready():
+    # on_ready fires again after every reconnect; sync only once per process.
+    # The prototype keeps no record of what it sent, so leftovers are only
+    # cleaned up from the player's channel on exit (bot2.py tracks message ids).
+    if commands_synced:
+        return
+    commands_synced = True
     await tree.sync()
-    print(f"✅ {bot.user} is ready.".encode('ascii', 'ignore').decode())
-
-    for guild in bot.guilds:
-        for channel in guild.text_channels:
-            if not channel.permissions_for(guild.me).read_message_history:
-                continue  # ข้ามถ้าไม่มีสิทธิ์อ่านประวัติ
-            if not channel.permissions_for(guild.me).manage_messages:
-                continue  # ข้ามถ้าไม่มีสิทธิ์ลบข้อความ
-
-            try:
-                async for msg in channel.history(limit=50):
-                    if msg.author.id == bot.user.id:
-                        await msg.delete()
-            except discord.Forbidden:
-                print(f"❌ ไม่มีสิทธิ์ลบในห้อง {channel.name} ({channel.id})")
-            except discord.HTTPException as e:
-                print(f"⚠️ ลบข้อความไม่สำเร็จ: {e}")
 
 # ✅ Run the bot
 bot.run(TOKEN)
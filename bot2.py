@@ -5,12 +5,26 @@ from discord import app_commands
 import yt_dlp
 import asyncio
 from dotenv import load_dotenv
-from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import itertools
 import sqlite3
+import json
+import hashlib
 from datetime import timedelta
-import re
 import sys
+import time
+import math
+import threading
 import logging
+import subprocess
+from cache import AudioCache, TTLCache
+from audio import OggOpusAudio, PackedOpusAudio, encode_packed_opus
+from monitoring import (resident_memory, format_bytes, stats, timed, timing, LoopMonitor,
+                        instrument_http, start_metrics_server)
+from voice_worker import VoiceWorkerPool, RemoteOpusAudio
+from journal import QueueJournal
+from tracks import Track, TrackQueue, track_record, stream_url_expiry
 
 # Set up logging
 logging.basicConfig(filename='bot.log', level=logging.INFO, 
@@ -22,15 +36,111 @@ if sys.platform == "win32":
 
 load_dotenv()
 TOKEN = os.getenv("DISCORD_TOKEN")
-intents = discord.Intents.all()
-intents.message_content = True
-bot = commands.Bot(command_prefix="!", intents=intents, reconnect=True)
+
+# Deployment mode. SHARD_COUNT/SHARD_IDS switch to AutoShardedBot, and a process
+# can run a slice of the shards ("0,1,2,3" of SHARD_COUNT=16). MINIMAL_INTENTS=0
+# falls back to every intent and a full member and message cache.
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0")) or None
+SHARD_IDS = [int(shard) for shard in os.getenv("SHARD_IDS", "").split(",") if shard.strip()] or None
+AUTO_SHARD = os.getenv("AUTO_SHARD", "0") == "1" or SHARD_COUNT is not None or SHARD_IDS is not None
+MINIMAL_INTENTS = os.getenv("MINIMAL_INTENTS", "1") != "0"
+if SHARD_IDS is not None and SHARD_COUNT is None:
+    raise SystemExit("SHARD_IDS needs SHARD_COUNT")
+
+def owns_guild(guild_id):
+    # Whether this process runs the shard a guild belongs to. Ledger rows from
+    # before guild ids were recorded are only claimed by a process running every shard.
+    if SHARD_IDS is None:
+        return True
+    return guild_id is not None and (guild_id >> 22) % SHARD_COUNT in SHARD_IDS
+
+if MINIMAL_INTENTS:
+    # Slash commands and button presses arrive as interactions whatever the
+    # intents; the player needs guilds and voice states, and the owner-only
+    # prefix commands need message events. Without message content only
+    # messages that mention the bot carry text, so those commands must be
+    # invoked as "@Bot stats" rather than "!stats".
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.voice_states = True
+    intents.guild_messages = True
+    intents.dm_messages = True
+    bot_options = {
+        "member_cache_flags": discord.MemberCacheFlags.from_intents(intents),  # Only members in voice
+        "max_messages": None,  # Interactions carry their message, nothing reads the message cache
+        "chunk_guilds_at_startup": False,
+    }
+else:
+    intents = discord.Intents.all()
+    intents.message_content = True
+    bot_options = {}
+
+if AUTO_SHARD:
+    bot = commands.AutoShardedBot(command_prefix=commands.when_mentioned_or("!"), intents=intents, reconnect=True,
+                                  shard_count=SHARD_COUNT, shard_ids=SHARD_IDS, **bot_options)
+else:
+    bot = commands.Bot(command_prefix=commands.when_mentioned_or("!"), intents=intents, reconnect=True, **bot_options)
 tree = bot.tree
 
 music_players = {}
+player_messages = {}  # Now-playing embed message id -> MusicPlayer
+FAVORITES_DB = "favorites.db"
+FAVORITES_FLUSH_DELAY = 0.5  # Seconds ⭐ presses are buffered before one batched write
+FAVORITES_PAGE_SIZE = 100  # Rows per favorites read
+STATE_DB = "state.db"  # Bot-side bookkeeping: the sent-message ledger and persistent settings
+BULK_DELETE_MAX_AGE = timedelta(days=13, hours=23)  # Discord only bulk deletes messages younger than 14 days
 CACHE_DIR = "cache"
 MAX_CACHE_SIZE = 1 * 1024 * 1024 * 1024  # 1GB
+CACHE_LOW_WATER = int(MAX_CACHE_SIZE * 0.8)  # Eviction stops once the cache is below this
+CACHE_ACCESS_FLUSH = 60  # Seconds between writes of buffered cache access times
 MAX_SKIP_ATTEMPTS = 3  # Limit skips per song
+SKIP_BACKOFF = 2  # Seconds to wait after a track fails before moving to the next one
+FFMPEG_EXECUTABLE = "bin\\ffmpeg.exe"
+FFMPEG_BEFORE_OPTIONS = "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+OPUS_PASSTHROUGH = True  # Send Opus packets to Discord as-is instead of decoding to PCM and re-encoding
+VOICE_WORKERS = int(os.getenv("VOICE_WORKERS", "0"))  # Processes running FFmpeg streams, 0 keeps them in the bot process
+EXTRACT_WORKERS = 4  # Concurrent yt-dlp metadata extractions
+DOWNLOAD_WORKERS = 2  # Concurrent cache downloads
+PREFETCH_DEPTH = 2  # Upcoming queue entries resolved ahead of time
+STREAM_EXPIRY_MARGIN = 600  # Seconds a stream URL must outlive the track by
+METADATA_DB = "metadata.db"  # On-disk layer for the metadata caches, None keeps them in memory only
+METADATA_CACHE_SIZE = 2048  # Entries kept in memory per metadata cache
+SEARCH_CACHE_TTL = 3600  # Upper bound for reusing search results
+PLAYLIST_BATCH_SIZE = 25  # Playlist entries appended to the queue at a time
+RESOLVE_CONCURRENCY = 8  # Favorites resolved at the same time per /fav
+EMBED_DEBOUNCE = 1.0  # Seconds of player changes coalesced into one embed edit
+EMBED_QUEUE_LINES = 15  # Queue entries listed in the embed
+EMBED_FIELD_LIMIT = 1024  # Discord's limit for an embed field value
+NOTICE_TTL = 5  # Seconds transient status messages stay up
+NOTICE_MERGE_WINDOW = 0.3  # Notices to one channel within this window go out as one message
+EXPIRY_TICK = 1.0  # Resolution of the message expiry wheel, in seconds
+EXPIRY_SLOTS = 64  # Slots on the message expiry wheel
+PRESS_DEBOUNCE = 1.0  # Seconds a user's repeat presses on one player are ignored
+QUEUE_JOURNAL_DIR = "queues"  # Per-guild queue journals, replayed after a restart
+QUEUE_COMPACT_AFTER = 500  # Journal lines before a guild's journal is rewritten as one snapshot
+POSITION_CHECKPOINT = 10  # Seconds between playback position entries in the journal
+IDLE_TIMEOUT = 300  # Seconds a player may sit paused, stopped or alone before it is hibernated
+REAPER_INTERVAL = 30  # Seconds between idle player sweeps
+VOICE_LOST_GRACE = 5  # Seconds to wait for a reconnect after the bot left voice before hibernating
+SKIP_ATTEMPTS_TRACKED = 50  # Failing tracks whose attempts a player remembers
+SOURCE_SWAP_GRACE = 0.5  # Seconds a replaced source stays open for a read still in flight
+LOOP_LAG_INTERVAL = 0.5  # Seconds between event loop lag samples
+LOOP_STALL_THRESHOLD = 1.0  # Seconds the loop may be unresponsive before its stack is logged
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # Prometheus text endpoint at /metrics, 0 disables it
+METRICS_PREFIX = "musicbot_"
+STREAM_INFO_FIELDS = ("url", "id", "extractor_key", "acodec", "duration", "webpage_url")
+
+# yt-dlp is fully synchronous, so extraction and cache downloads run on bounded
+# pools instead of the event loop. Downloads get their own pool so a slow cache
+# fill never holds up resolving the next track.
+extract_executor = ThreadPoolExecutor(max_workers=EXTRACT_WORKERS, thread_name_prefix="ytdlp-extract")
+download_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="ytdlp-download")
+background_tasks = set()
+# Streams read FFmpeg in worker processes so pipe reading and Ogg demuxing do
+# not share the gateway's GIL. Voice connections stay here: they are tied to
+# this process's gateway session and its voice encryption state.
+voice_pool = VoiceWorkerPool(VOICE_WORKERS) if VOICE_WORKERS > 0 else None
 
 REACTS = {
     "⏮️": "prev",
@@ -42,61 +152,575 @@ REACTS = {
     "❌": "exit"
 }
 
-# Initialize SQLite database
-def init_db():
-    conn = sqlite3.connect("favorites.db")
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS favorites
-                 (user_id INTEGER, song_title TEXT, song_url TEXT, thumbnail TEXT)''')
-    conn.commit()
-    conn.close()
-
-# Add favorite song to database
-def add_favorite(user_id, song_title, song_url, thumbnail):
-    conn = sqlite3.connect("favorites.db")
-    c = conn.cursor()
-    c.execute("INSERT INTO favorites (user_id, song_title, song_url, thumbnail) VALUES (?, ?, ?, ?)",
-              (user_id, song_title, song_url, thumbnail))
-    conn.commit()
-    conn.close()
-    logging.info(f"Added favorite: {song_title} with URL {song_url} for user {user_id}")
-
-# Get favorite songs for a user
-def get_favorites(user_id):
-    conn = sqlite3.connect("favorites.db")
-    c = conn.cursor()
-    c.execute("SELECT song_title, song_url, thumbnail FROM favorites WHERE user_id = ?", (user_id,))
-    favorites = c.fetchall()
-    conn.close()
-    return [{"title": row[0], "url": row[1], "thumbnail": row[2]} for row in favorites]
+# Favorites storage
+class FavoritesStore:
+    # One long-lived WAL connection owned by a single worker thread, so
+    # favorites traffic never runs SQLite on the event loop. Writes from bursts
+    # of ⭐ presses are buffered briefly and committed as one transaction.
+    def __init__(self, path):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="favorites-db")
+        self._conn = None
+        self._pending = []
+        self._flush_task = None
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+
+    async def open(self):
+        await self._run(self._open)
+
+    def _open(self):
+        if self._conn is not None:
+            return
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute('''CREATE TABLE IF NOT EXISTS favorites
+                        (user_id INTEGER, song_title TEXT, song_url TEXT, thumbnail TEXT)''')
+        has_index = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'favorites_user_song'").fetchone()
+        if not has_index:
+            # Older databases can hold the same song starred repeatedly; keep the first star
+            conn.execute("DELETE FROM favorites WHERE rowid NOT IN "
+                         "(SELECT MIN(rowid) FROM favorites GROUP BY user_id, song_url)")
+            conn.execute("CREATE UNIQUE INDEX favorites_user_song ON favorites (user_id, song_url)")
+        conn.commit()
+        self._conn = conn
+
+    def add(self, user_id, song_title, song_url, thumbnail):
+        self._pending.append((user_id, song_title, song_url, thumbnail))
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(FAVORITES_FLUSH_DELAY)
+        await self.flush()
+        if self._pending:
+            # Stars added during the write, or a batch put back after a failure
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def flush(self):
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            await self._run(self._write, batch)
+        except sqlite3.Error as e:
+            # Keep the batch ahead of anything starred meanwhile so the next flush retries it
+            self._pending[:0] = batch
+            logging.error(f"Failed to save {len(batch)} favorite(s): {str(e)}")
+
+    async def close(self):
+        if self._flush_task is not None and self._flush_task is not asyncio.current_task():
+            self._flush_task.cancel()
+        await self.flush()
+        if self._pending:
+            logging.error(f"Discarding {len(self._pending)} unsaved favorite(s) at shutdown")
+        await self._run(self._close)
+        self._executor.shutdown(wait=False)
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _write(self, batch):
+        self._open()
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO favorites (user_id, song_title, song_url, thumbnail) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (user_id, song_url) DO UPDATE SET song_title = excluded.song_title, thumbnail = excluded.thumbnail",
+                batch)
+        for user_id, song_title, song_url, _ in batch:
+            logging.info(f"Added favorite: {song_title} with URL {song_url} for user {user_id}")
+
+    def _read_page(self, user_id, after, limit):
+        self._open()
+        return self._conn.execute(
+            "SELECT rowid, song_title, song_url, thumbnail FROM favorites WHERE user_id = ? AND rowid > ? "
+            "ORDER BY rowid LIMIT ?", (user_id, after, limit)).fetchall()
+
+    async def get_page(self, user_id, after=0, limit=FAVORITES_PAGE_SIZE):
+        # Keyset pagination: pass the last row id of the previous page as `after`
+        await self.flush()
+        rows = await self._run(self._read_page, user_id, after, limit)
+        return [{"id": row[0], "title": row[1], "url": row[2], "thumbnail": row[3]} for row in rows]
+
+    async def iter_favorites(self, user_id):
+        after = 0
+        while True:
+            page = await self.get_page(user_id, after)
+            for favorite in page:
+                yield favorite
+            if len(page) < FAVORITES_PAGE_SIZE:
+                return
+            after = page[-1]["id"]
+
+favorites_store = FavoritesStore(FAVORITES_DB)
+
+# Sent-message ledger
+class MessageLedger:
+    # Persistent record of the channel messages the bot sent and has not
+    # deleted yet, so cleanup goes straight to those channels and ids instead
+    # of walking the history of every channel the bot can see.
+    def __init__(self, path):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ledger-db")
+        self._conn = None
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+
+    async def open(self):
+        await self._run(self._open)
+
+    def _open(self):
+        if self._conn is not None:
+            return
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute('''CREATE TABLE IF NOT EXISTS bot_messages
+                        (message_id INTEGER PRIMARY KEY, channel_id INTEGER NOT NULL)''')
+        conn.execute("CREATE INDEX IF NOT EXISTS bot_messages_channel ON bot_messages (channel_id)")
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(bot_messages)")]
+        if "guild_id" not in columns:
+            # Processes running other shards share the ledger and purge only their own guilds
+            conn.execute("ALTER TABLE bot_messages ADD COLUMN guild_id INTEGER")
+        conn.commit()
+        self._conn = conn
+
+    def record(self, msg):
+        # Fire and forget; the single worker thread keeps records and deletes in order
+        guild_id = msg.guild.id if msg.guild else None
+        self._executor.submit(self._write, "INSERT OR IGNORE INTO bot_messages (message_id, channel_id, guild_id) VALUES (?, ?, ?)",
+                              [(msg.id, msg.channel.id, guild_id)])
+
+    def forget(self, message_ids):
+        if message_ids:
+            self._executor.submit(self._write, "DELETE FROM bot_messages WHERE message_id = ?",
+                                  [(message_id,) for message_id in message_ids])
+
+    def _write(self, sql, rows):
+        try:
+            self._open()
+            with self._conn:
+                self._conn.executemany(sql, rows)
+        except sqlite3.Error as e:
+            logging.error(f"Failed to update message ledger: {str(e)}")
+
+    def _read(self, channel_id, owns_guild):
+        self._open()
+        if channel_id is None:
+            rows = self._conn.execute("SELECT channel_id, message_id, guild_id FROM bot_messages").fetchall()
+        else:
+            rows = self._conn.execute("SELECT channel_id, message_id, guild_id FROM bot_messages WHERE channel_id = ?",
+                                      (channel_id,)).fetchall()
+        by_channel = {}
+        for row_channel, message_id, guild_id in rows:
+            if owns_guild is None or owns_guild(guild_id):
+                by_channel.setdefault(row_channel, []).append(message_id)
+        return by_channel
+
+    async def messages_by_channel(self, channel_id=None, owns_guild=None):
+        # owns_guild filters on the guild id (None for rows recorded before it was kept)
+        return await self._run(self._read, channel_id, owns_guild)
+
+message_ledger = MessageLedger(STATE_DB)
+
+# Persistent settings
+class SettingsStore:
+    # Key/value settings that must survive restarts, such as the hash of the
+    # last uploaded command tree. They are read and written a handful of times
+    # per process, so each call opens its own connection on the default executor.
+    def __init__(self, path):
+        self.path = path
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        return conn
+
+    def _get(self, key):
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+            return row[0] if row else None
+        finally:
+            conn.close()
+
+    def _set(self, key, value):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
+        finally:
+            conn.close()
+
+    async def get(self, key):
+        return await asyncio.get_running_loop().run_in_executor(None, self._get, key)
+
+    async def set(self, key, value):
+        await asyncio.get_running_loop().run_in_executor(None, self._set, key, value)
+
+settings_store = SettingsStore(STATE_DB)
+
+async def purge_messages(channel_id, message_ids):
+    # Deletes the given bot messages with as few requests as possible: bulk
+    # deletes of up to 100 where Discord allows it, one by one otherwise
+    cutoff = discord.utils.time_snowflake(discord.utils.utcnow() - BULK_DELETE_MAX_AGE)
+    recent = sorted(m for m in message_ids if m > cutoff)
+    singles = [m for m in message_ids if m <= cutoff]
+    try:
+        for idx in range(0, len(recent), 100):
+            chunk = recent[idx:idx + 100]
+            if len(chunk) == 1:
+                singles.extend(chunk)
+                continue
+            try:
+                await bot.http.delete_messages(channel_id, chunk)
+            except discord.Forbidden:
+                # Bulk delete needs Manage Messages, deleting our own messages does not
+                singles.extend(chunk)
+        for message_id in singles:
+            try:
+                await bot.http.delete_message(channel_id, message_id)
+            except discord.NotFound:
+                pass
+    except discord.NotFound:
+        pass  # The channel itself is gone
+    except discord.Forbidden:
+        logging.error(f"No permission to delete messages in channel {channel_id}")
+    except discord.HTTPException as e:
+        # Keep the ids so the next start retries them
+        logging.error(f"Failed to delete messages in channel {channel_id}: {str(e)}")
+        return
+    message_ledger.forget(message_ids)
+
+async def purge_ledger():
+    # Clears whatever a previous run left behind; runs once per process, and
+    # only for this process's shards so other processes keep their live messages
+    by_channel = await message_ledger.messages_by_channel(owns_guild=owns_guild)
+    for channel_id, message_ids in by_channel.items():
+        await purge_messages(channel_id, message_ids)
+    if by_channel:
+        logging.info(f"Purged leftover bot messages in {len(by_channel)} channels")
+
+# Transient notices
+class Notifier:
+    # Central service for short-lived status messages. Notices for a channel
+    # are merged per burst and sent by one worker per channel, so a channel's
+    # send bucket never sees more than one request at a time. Expiries go on a
+    # timer wheel that deletes each channel's due messages in bulk where it can.
+    def __init__(self, tick=EXPIRY_TICK, slots=EXPIRY_SLOTS):
+        self._pending = {}
+        self._workers = {}
+        self._tick = tick
+        self._wheel = [[] for _ in range(slots)]
+        self._cursor = 0
+        self._wheel_task = None
+
+    def notify(self, channel, text, ttl=NOTICE_TTL):
+        # Returns immediately; the message goes out with the channel's next burst
+        if channel is None:
+            return
+        pending = self._pending.get(channel.id)
+        if pending is None:
+            self._pending[channel.id] = [channel, ttl, [text]]
+        else:
+            # A merged message stays up as long as its longest-lived notice
+            pending[1] = None if ttl is None or pending[1] is None else max(ttl, pending[1])
+            pending[2].append(text)
+        worker = self._workers.get(channel.id)
+        if worker is None or worker.done():
+            self._workers[channel.id] = asyncio.create_task(self._channel_worker(channel.id))
+
+    async def followup(self, interaction, text, ttl=NOTICE_TTL):
+        try:
+            msg = await interaction.followup.send(text, ephemeral=True)
+        except (discord.errors.NotFound, discord.Forbidden):
+            return
+        self.expire(msg, ttl)
+
+    async def _channel_worker(self, channel_id):
+        while channel_id in self._pending:
+            await asyncio.sleep(NOTICE_MERGE_WINDOW)
+            channel, ttl, lines = self._pending.pop(channel_id)
+            try:
+                msg = await channel.send("\n".join(lines)[:2000])
+                message_ledger.record(msg)
+                self.expire(msg, ttl)
+            except discord.Forbidden:
+                logging.error(f"No permission to send message in {channel.name}")
+            except discord.HTTPException as e:
+                logging.error(f"Failed to send notice in {channel.name}: {str(e)}")
+
+    def expire(self, msg, ttl):
+        if ttl is None:
+            return
+        ticks = max(1, int(ttl / self._tick))
+        slot = (self._cursor + ticks) % len(self._wheel)
+        # A slot is next visited after one full turn, so an exact multiple of
+        # the wheel length needs one round fewer
+        self._wheel[slot].append(((ticks - 1) // len(self._wheel), msg))
+        if self._wheel_task is None or self._wheel_task.done():
+            self._wheel_task = asyncio.create_task(self._run_wheel())
+
+    async def _run_wheel(self):
+        while any(self._wheel):
+            await asyncio.sleep(self._tick)
+            self._cursor = (self._cursor + 1) % len(self._wheel)
+            due = []
+            waiting = []
+            for rounds, msg in self._wheel[self._cursor]:
+                if rounds:
+                    waiting.append((rounds - 1, msg))
+                else:
+                    due.append(msg)
+            self._wheel[self._cursor] = waiting
+            if due:
+                spawn_background(self._delete_due(due))
+
+    async def _delete_due(self, messages):
+        by_channel = {}
+        for msg in messages:
+            # Ephemeral followups are webhook messages and can only be deleted one by one
+            channel = None if isinstance(msg, discord.WebhookMessage) else msg.channel
+            by_channel.setdefault(channel, []).append(msg)
+        for channel, msgs in by_channel.items():
+            try:
+                if channel is not None and len(msgs) > 1 and channel.permissions_for(channel.guild.me).manage_messages:
+                    for idx in range(0, len(msgs), 100):
+                        await channel.delete_messages(msgs[idx:idx + 100])
+                else:
+                    for msg in msgs:
+                        await msg.delete()
+            except discord.NotFound:
+                pass
+            except discord.Forbidden:
+                logging.error(f"No permission to delete messages in {getattr(channel, 'name', 'followup')}")
+                continue
+            except discord.HTTPException as e:
+                logging.error(f"Failed to delete expired notices: {str(e)}")
+                continue
+            if channel is not None:
+                message_ledger.forget([msg.id for msg in msgs])
+
+notifier = Notifier()
+
+# Event loop instrumentation
+loop_monitor = LoopMonitor(LOOP_LAG_INTERVAL, LOOP_STALL_THRESHOLD)
+
+# Queue persistence
+queue_journal = QueueJournal(QUEUE_JOURNAL_DIR, QUEUE_COMPACT_AFTER)
+pending_restores = set()  # Guilds with a journal that have not been restored yet
+hibernated = set()  # Guilds whose idle player was freed; their queue waits in the journal
 
 # Cache management
-def ensure_cache_dir():
-    if not os.path.exists(CACHE_DIR):
-        os.makedirs(CACHE_DIR)
-
-def get_cache_size():
-    total_size = 0
-    for dirpath, _, filenames in os.walk(CACHE_DIR):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            total_size += os.path.getsize(fp)
-    return total_size
-
-def clear_oldest_cache():
-    files = [(os.path.join(CACHE_DIR, f), os.path.getmtime(os.path.join(CACHE_DIR, f)))
-             for f in os.listdir(CACHE_DIR) if os.path.isfile(os.path.join(CACHE_DIR, f))]
-    if files:
-        oldest_file = min(files, key=lambda x: x[1])[0]
-        os.remove(oldest_file)
-
-def sanitize_filename(filename):
-    return re.sub(r'[<>:"/\\|?*]', '_', filename)
+audio_cache = AudioCache(CACHE_DIR, MAX_CACHE_SIZE, CACHE_LOW_WATER)
+search_cache = TTLCache(METADATA_CACHE_SIZE, SEARCH_CACHE_TTL, METADATA_DB, namespace="search")
+stream_info_cache = TTLCache(METADATA_CACHE_SIZE, 0, METADATA_DB, namespace="stream")
+
+def cache_key_for(song):
+    return AudioCache.key_for(song.extractor, song.id)
+
+def cached_path_for(song):
+    key = cache_key_for(song)
+    path = audio_cache.lookup(key) if key else None
+    stats.inc("cache_lookups_total", cache="audio", result="hit" if path else "miss")
+    return path
+
+# Stream URL freshness
+async def flush_cache_access():
+    # Cache hits only note their access time; the index is updated off the loop
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(CACHE_ACCESS_FLUSH)
+        try:
+            await loop.run_in_executor(download_executor, audio_cache.flush_access)
+        except sqlite3.Error as e:
+            logging.error(f"Failed to write cache access times: {str(e)}")
+
+def is_stream_fresh(song):
+    if not song.stream_url or not song.expires:
+        return False
+    return song.expires - time.time() > song.duration + STREAM_EXPIRY_MARGIN
+
+def stream_ttl(url, duration):
+    # How long a resolved stream stays good enough for is_stream_fresh
+    expires = stream_url_expiry(url)
+    if not expires:
+        return 0
+    return expires - time.time() - (duration or 0) - STREAM_EXPIRY_MARGIN
+
+# Executors
+async def run_extract(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(extract_executor, functools.partial(func, *args))
+
+def spawn_background(coro):
+    # Keep a strong reference so fire-and-forget jobs are not garbage collected mid-run
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+class SingleFlight:
+    # Concurrent callers asking for the same key share one in-flight job and
+    # all receive its result (or its exception)
+    def __init__(self):
+        self._inflight = {}
+
+    def _finished(self, key, future):
+        self._inflight.pop(key, None)
+        if not future.cancelled():
+            future.exception()  # Mark as retrieved even if every waiter went away
+
+    async def run(self, key, factory):
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(factory())
+            self._inflight[key] = future
+            future.add_done_callback(functools.partial(self._finished, key))
+        # Shielded so one cancelled waiter does not cancel the job for the others
+        return await asyncio.shield(future)
+
+extract_flight = SingleFlight()
+download_flight = SingleFlight()
+
+def _extract_stream(url):
+    ydl_opts = {"format": "bestaudio/best", "quiet": True, "geo_bypass": True}
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+    # Only what playback needs; this is also what the metadata cache stores
+    return {field: info.get(field) for field in STREAM_INFO_FIELDS}
+
+def _download_to_cache(url, key):
+    # Download under a temporary name, pack into frame-indexed Opus and let the
+    # cache rename the result into place
+    temp_path = audio_cache.temp_path(key)
+    source_path = temp_path + ".src"
+    ydl_opts = {"outtmpl": source_path, "format": "bestaudio/best", "quiet": True, "geo_bypass": True}
+    try:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(url, download=True)
+        stats.add_gauge("ffmpeg_processes", 1, kind="encode")
+        try:
+            encode_packed_opus(FFMPEG_EXECUTABLE, source_path, temp_path, copy=info.get('acodec') == "opus")
+        finally:
+            stats.add_gauge("ffmpeg_processes", -1, kind="encode")
+        return audio_cache.commit(key, temp_path, "opf")
+    except BaseException:
+        audio_cache.discard(temp_path)
+        raise
+    finally:
+        audio_cache.discard(source_path)
+
+def ffmpeg_before_options(start=0):
+    # Input seeking: FFmpeg jumps straight to the offset instead of decoding up to it
+    return f"{FFMPEG_BEFORE_OPTIONS} -ss {start:.2f}" if start else FFMPEG_BEFORE_OPTIONS
+
+def open_remote_source(song, cache_path, start=0):
+    # Packed and Ogg cache entries are cheap to serve locally; anything that
+    # needs an FFmpeg process goes to a voice worker when there are any
+    if voice_pool is None or (cache_path and cache_path.endswith((".opf", ".opus"))):
+        return None
+    copy = OPUS_PASSTHROUGH and not cache_path and song.acodec == "opus"
+    return voice_pool.open_stream({
+        "source": cache_path or song.url,
+        "codec": "copy" if copy else None,
+        "before_options": ffmpeg_before_options(start),
+        "options": "-vn",
+        "executable": FFMPEG_EXECUTABLE,
+    })
+
+def create_source(song, cache_path=None, start=0):
+    remote = open_remote_source(song, cache_path, start)
+    if remote is not None:
+        return remote
+    # Cached entries are Opus frames already, whatever OPUS_PASSTHROUGH says;
+    # FFmpeg cannot read the packed container anyway
+    if cache_path and cache_path.endswith(".opf"):
+        return PackedOpusAudio(cache_path, start)
+    if cache_path and cache_path.endswith(".opus"):
+        # Ogg/Opus entries cached before the packed format
+        return OggOpusAudio(cache_path, start)
+    if not OPUS_PASSTHROUGH:
+        return discord.FFmpegPCMAudio(
+            cache_path or song.url,
+            before_options=ffmpeg_before_options(start),
+            options="-vn",
+            executable=FFMPEG_EXECUTABLE
+        )
+    # Opus streams (YouTube's usual bestaudio) are remuxed by FFmpeg without re-encoding
+    return discord.FFmpegOpusAudio(
+        cache_path or song.url,
+        codec="copy" if not cache_path and song.acodec == "opus" else None,
+        before_options=ffmpeg_before_options(start),
+        options="-vn",
+        executable=FFMPEG_EXECUTABLE
+    )
+
+def swap_source(voice_client, source):
+    # Replaces the playing source on the existing connection; the after
+    # callback stays bound and playback resumes if it was paused. The player
+    # thread may still be reading the old source, so it is closed a moment later.
+    old = voice_client.source
+    voice_client.source = source
+    if old is not None:
+        asyncio.get_running_loop().call_later(SOURCE_SWAP_GRACE, old.cleanup)
+
+async def _cache_download(song, key):
+    loop = asyncio.get_running_loop()
+    try:
+        cache_path = await loop.run_in_executor(download_executor, _download_to_cache, song.webpage_url, key)
+        logging.info(f"Cached {song.title} at {cache_path}")
+        return cache_path
+    except yt_dlp.utils.DownloadError as e:
+        logging.error(f"Failed to cache {song.title}: {str(e)}")
+    except subprocess.CalledProcessError as e:
+        logging.error(f"Failed to encode {song.title} for the cache: {e.stderr.decode(errors='replace').strip()}")
+    except OSError as e:
+        logging.error(f"Failed to write cache for {song.title}: {str(e)}")
+    return None
+
+async def cache_song(song):
+    # Guilds caching the same track share one download
+    key = cache_key_for(song)
+    if not key or audio_cache.contains(key):
+        return None
+    return await download_flight.run(key, lambda: _cache_download(song, key))
+
+async def fetch_stream_info(url):
+    started = time.perf_counter()
+    info = await run_extract(_extract_stream, url)
+    stats.observe("extract_seconds", time.perf_counter() - started, kind="stream")
+    # Remember the result under every name a later request may use, for as
+    # long as the googlevideo URL stays valid
+    ttl = stream_ttl(info['url'], info.get('duration'))
+    for key in {url, info.get('webpage_url'), AudioCache.key_for(info.get('extractor_key'), info.get('id'))}:
+        if key:
+            stream_info_cache.set(key, info, ttl)
+    return info
+
+async def resolve_stream(song):
+    # Repeat plays reuse cached stream info; guilds resolving the same track
+    # at the same time share one extraction
+    url = song.webpage_url
+    flight_key = cache_key_for(song) or url
+    info = stream_info_cache.get(flight_key)
+    stats.inc("cache_lookups_total", cache="stream", result="miss" if info is None else "hit")
+    if info is None:
+        info = await extract_flight.run(flight_key, lambda: fetch_stream_info(url))
+    song.apply_stream_info(info)
+    return song
 
 class MusicPlayer:
     def __init__(self, guild):
         self.guild = guild
-        self.queue = deque()
+        self.queue = TrackQueue()
         self.current = None
         self.previous = None
         self.loop = False
@@ -105,187 +729,474 @@ class MusicPlayer:
         self.text_channel = None
         self.skip_attempts = {}
         self.is_exiting = False
+        self.prefetch_task = None
+        self.refresh_handle = None  # Timer re-running prefetch when a prefetched stream URL goes stale
+        self.embed_task = None
+        self.embed_dirty = False
+        self.last_rendered = None
+        self.last_presses = {}
+        self.position_offset = 0  # Playback position when position_started was taken
+        self.position_started = None  # Monotonic time playback last (re)started, None while paused or idle
+        self.track_ended = None  # Monotonic time the last track finished, for the gap metric
+        self.idle_since = None  # Monotonic time the reaper first saw the player idle
+        self.auto_paused = False  # Paused because everyone left the voice channel
+        self.play_generation = 0  # Bumped by every play(); after callbacks of older plays are ignored
+        self.requeued = False  # The current track is already back in the queue, so advancing must not re-add it
+        self.woken = False  # Rebuilt from the journal and not started yet; the next /play or /fav starts it
 
-    async def play_next(self):
-        if self.is_exiting:
-            logging.info("play_next skipped due to exit flag")
-            return
+    def journal(self, *op):
+        queue_journal.append(self.guild.id, *op)
+        if queue_journal.needs_compaction(self.guild.id):
+            self.checkpoint()
+
+    def checkpoint(self):
+        # Rewrites the guild's journal as a single snapshot of the current state
+        queue_journal.compact(self.guild.id, self.snapshot())
+
+    def snapshot(self, with_streams=False):
+        record = functools.partial(track_record, with_stream=with_streams)
+        return {
+            "queue": [record(song) for song in self.queue],
+            "current": record(self.current),
+            "previous": record(self.previous),
+            "loop": self.loop,
+            "position": round(self.playback_position(), 2),
+            "voice_channel": self.voice_client.channel.id if self.voice_client and self.voice_client.channel else None,
+            "text_channel": self.text_channel.id if self.text_channel else None,
+        }
+
+    def enqueue(self, songs):
+        self.queue.extend(songs)
+        self.journal("extend", [track_record(song) for song in songs])
 
-        if self.loop and self.current:
-            self.queue.append(self.current)
+    def bind_channels(self):
+        if self.voice_client and self.voice_client.channel and self.text_channel:
+            self.journal("channels", self.voice_client.channel.id, self.text_channel.id)
+
+    def playback_position(self):
+        if self.position_started is None:
+            return self.position_offset
+        return self.position_offset + time.monotonic() - self.position_started
+
+    def mark_paused(self):
+        self.position_offset = self.playback_position()
+        self.position_started = None
+        self.journal("position", round(self.position_offset, 2))
+
+    def mark_resumed(self):
+        if self.position_started is None and self.current:
+            self.position_started = time.monotonic()
+
+    def stream_expired(self):
+        # Whether the paused source is an FFmpeg stream whose URL will run out
+        # before the rest of the track has been read
+        remaining = (self.current.duration or 0) - self.position_offset
+        return (isinstance(self.voice_client.source, (discord.FFmpegAudio, RemoteOpusAudio))
+                and self.current.expires is not None
+                and self.current.expires - time.time() < remaining + STREAM_EXPIRY_MARGIN)
+
+    async def resume(self):
+        # A stream left paused past its URL's expiry cannot reconnect, so it
+        # is reopened at the saved position instead
+        if self.stream_expired():
+            await self.seek(self.position_offset)
         else:
-            self.previous = self.current
+            self.voice_client.resume()
+            self.mark_resumed()
+        self.auto_paused = False
 
-        if not self.queue:
-            self.current = None
-            if self.message:
-                try:
-                    msg = await self.text_channel.send("❌ No more songs in the queue.")
-                    await asyncio.sleep(5)
-                    await msg.delete()
-                except discord.Forbidden:
-                    logging.error(f"No permission to send/delete message in {self.text_channel.name}")
+    async def seek(self, position):
+        # Restarts the current track at `position` on the existing connection.
+        # Cached files are reopened at the offset and streams use FFmpeg input
+        # seeking, so this takes milliseconds where a voice reconnect takes seconds.
+        cache_path = cached_path_for(self.current)
+        if not cache_path and not is_stream_fresh(self.current):
+            await resolve_stream(self.current)
+            cache_path = cached_path_for(self.current)
+        if not (self.voice_client.is_playing() or self.voice_client.is_paused()):
+            await self.start_current(position)
             return
+        source = create_source(self.current, cache_path, position)
+        if source.is_opus() == self.voice_client.source.is_opus():
+            swap_source(self.voice_client, source)
+        else:
+            # discord.py only creates the Opus encoder in play() for PCM
+            # sources, so switching between Opus and PCM needs a fresh play().
+            # The stopped source's after callback must not advance the queue.
+            self.play_generation += 1
+            self.voice_client.stop()
+            self.play_source(source)
+        # Either way playback resumes on a paused client, so it is no longer paused or idle
+        self.auto_paused = False
+        self.idle_since = None
+        self.position_offset = position
+        self.position_started = time.monotonic()
+        self.journal("position", round(position, 2))
+        self.schedule_prefetch()
+        await self.send_embed()
 
-        self.current = self.queue.popleft()
-        song_title = self.current['title']
-        cache_path = os.path.join(CACHE_DIR, f"{sanitize_filename(song_title)}.mp3")
+    def listeners(self):
+        channel = self.voice_client.channel if self.voice_client else None
+        return [member for member in channel.members if not member.bot] if channel else []
 
-        # Log duration and URLs for debugging
-        duration = self.current.get("duration")
-        original_url = self.current.get("webpage_url")
-        logging.info(f"Playing {song_title}: duration={duration}, original_url={original_url}, stream_url={self.current['url']}")
+    def is_active(self):
+        # Playing to someone; anything else counts towards the idle timeout
+        return (self.voice_client is not None and self.voice_client.is_connected()
+                and self.voice_client.is_playing() and bool(self.listeners()))
 
-        # Check skip attempts
-        self.skip_attempts[song_title] = self.skip_attempts.get(song_title, 0) + 1
-        if self.skip_attempts[song_title] > MAX_SKIP_ATTEMPTS:
-            try:
-                await self.text_channel.send(f"❌ Skipped {song_title} after {MAX_SKIP_ATTEMPTS} failed attempts.")
-                self.skip_attempts[song_title] = 0
-                await self.play_next()
-            except discord.Forbidden:
-                logging.error(f"No permission to send message in {self.text_channel.name}")
-            return
+    @timed("play_next")
+    async def play_next(self):
+        # Advances until a track starts or the queue runs out. Failures loop
+        # here rather than recursing, so one call is timed once however many
+        # dead entries it skips.
+        while True:
+            if self.is_exiting:
+                logging.info("play_next skipped due to exit flag")
+                return
+            if not self.advance():
+                return
+            if await self.try_start():
+                return
+            await asyncio.sleep(SKIP_BACKOFF)
 
-        try:
-            if os.path.exists(cache_path):
-                source = discord.FFmpegPCMAudio(
-                    cache_path,
-                    before_options="-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
-                    options="-vn",
-                    executable="bin\\ffmpeg.exe"
-                )
+    def advance(self):
+        # Moves the next playable entry into current; False once the queue is empty
+        while True:
+            if self.requeued:
+                # /jump already put the current track back in the loop order
+                self.requeued = False
+            elif self.loop and self.current:
+                self.queue.append(self.current)
+                self.journal("extend", [track_record(self.current)])
             else:
-                ydl_opts = {"format": "bestaudio/best", "quiet": True, "geo_bypass": True}
+                self.previous = self.current
+                self.journal("previous", track_record(self.current))
+
+            self.position_offset = 0
+            self.position_started = None
+            if not self.queue:
+                self.current = None
+                self.journal("idle")
+                if self.message:
+                    notifier.notify(self.text_channel, "❌ No more songs in the queue.")
+                return False
+
+            self.current = self.queue.popleft()
+            self.journal("advance")
+            song_title = self.current.title
+
+            # Log duration and URLs for debugging
+            logging.info(f"Playing {song_title}: duration={self.current.duration}, original_url={self.current.webpage_url}, stream_url={self.current.stream_url}")
+
+            # Check skip attempts; only tracks that are failing are remembered, oldest dropped first
+            self.skip_attempts[song_title] = self.skip_attempts.get(song_title, 0) + 1
+            if len(self.skip_attempts) > SKIP_ATTEMPTS_TRACKED:
+                del self.skip_attempts[next(iter(self.skip_attempts))]
+            if self.skip_attempts.get(song_title, 0) <= MAX_SKIP_ATTEMPTS:
+                return True
+            notifier.notify(self.text_channel, f"❌ Skipped {song_title} after {MAX_SKIP_ATTEMPTS} failed attempts.", ttl=None)
+            stats.inc("track_failures_total", reason="attempts")
+            self.skip_attempts.pop(song_title, None)
+
+    async def start_current(self, start=0):
+        # Starts the current track, optionally part way in; a failure skips to the next one
+        if not await self.try_start(start):
+            await asyncio.sleep(SKIP_BACKOFF)
+            await self.play_next()
+
+    async def try_start(self, start=0):
+        # False when the current track failed and should be skipped
+        song_title = self.current.title
+        try:
+            cache_path = cached_path_for(self.current)
+            if not cache_path:
                 try:
-                    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                        info = ydl.extract_info(self.current['url'], download=False)
-                        self.current['url'] = info['url']
-                        self.current['duration'] = info.get('duration', self.current.get('duration', 0))
-                        self.current['webpage_url'] = info.get('webpage_url', self.current.get('webpage_url', self.current['url']))
-                        logging.info(f"Extracted new URL for {song_title}: {self.current['url']}")
+                    # Prefetched entries already carry a fresh stream URL
+                    if not is_stream_fresh(self.current):
+                        await resolve_stream(self.current)
+                        logging.info(f"Extracted new URL for {song_title}: {self.current.stream_url}")
+                        # The extractor and video id are known now, so the cache may already have it
+                        cache_path = cached_path_for(self.current)
                 except yt_dlp.utils.DownloadError as e:
                     logging.error(f"Failed to extract URL for {song_title}: {str(e)}")
-                    try:
-                        await self.text_channel.send(f"❌ Failed to play {song_title}. Skipping...")
-                        await asyncio.sleep(5)
-                        await self.play_next()
-                    except discord.Forbidden:
-                        logging.error(f"No permission to send message in {self.text_channel.name}")
-                    return
-
-                source = discord.FFmpegPCMAudio(
-                    self.current['url'],
-                    before_options="-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
-                    options="-vn",
-                    executable="bin\\ffmpeg.exe"
-                )
-                if get_cache_size() < MAX_CACHE_SIZE:
-                    ydl_opts = {"outtmpl": cache_path, "format": "bestaudio[ext=mp3]", "quiet": True}
-                    try:
-                        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                            ydl.download([self.current['url']])
-                        logging.info(f"Cached {song_title} at {cache_path}")
-                    except yt_dlp.utils.DownloadError as e:
-                        logging.error(f"Failed to cache {song_title}: {str(e)}")
-                else:
-                    clear_oldest_cache()
-                    try:
-                        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                            ydl.download([self.current['url']])
-                        logging.info(f"Cached {song_title} at {cache_path} after clearing oldest")
-                    except yt_dlp.utils.DownloadError as e:
-                        logging.error(f"Failed to cache {song_title}: {str(e)}")
+                    stats.inc("track_failures_total", reason="extract")
+                    notifier.notify(self.text_channel, f"❌ Failed to play {song_title}. Skipping...", ttl=None)
+                    return False
 
             if not self.voice_client or not self.voice_client.is_connected():
+                # Checked before the source exists, so no FFmpeg process is left behind
                 logging.error(f"Voice client not connected in guild {self.guild.id}")
-                return
+                return True
 
-            self.voice_client.play(
-                source,
-                after=lambda e: asyncio.run_coroutine_threadsafe(self.play_next(), bot.loop)
-            )
-            self.skip_attempts[song_title] = 0
+            source = create_source(self.current, cache_path, start)
+            if not cache_path:
+                # Populate the cache in the background; playback does not wait for it
+                spawn_background(cache_song(self.current))
+
+            self.play_source(source)
+            if self.track_ended is not None:
+                stats.observe("track_gap_seconds", time.monotonic() - self.track_ended)
+                self.track_ended = None
+            self.position_offset = start
+            self.position_started = time.monotonic()
+            self.skip_attempts.pop(song_title, None)
+            self.schedule_prefetch()
             await self.send_embed()
+            return True
         except Exception as e:
             logging.error(f"Error playing {song_title}: {str(e)}")
-            try:
-                await self.text_channel.send(f"❌ Failed to play {song_title}. Skipping...")
-                await asyncio.sleep(5)
-                await self.play_next()
-            except discord.Forbidden:
-                logging.error(f"No permission to send message in {self.text_channel.name}")
+            stats.inc("track_failures_total", reason="playback")
+            notifier.notify(self.text_channel, f"❌ Failed to play {song_title}. Skipping...", ttl=None)
+            return False
 
-    async def send_embed(self):
-        if not self.text_channel.permissions_for(self.guild.me).send_messages:
-            logging.error(f"No permission to send embed in {self.text_channel.name}")
+    def play_source(self, source):
+        self.play_generation += 1
+        self.voice_client.play(source, after=functools.partial(self._after_play, asyncio.get_running_loop(), self.play_generation))
+
+    def _after_play(self, loop, generation, error):
+        # Runs on the voice player thread when a track ends or is stopped
+        if error:
+            logging.error(f"Playback error in guild {self.guild.id}: {str(error)}")
+        if generation != self.play_generation:
+            # Stopped by seek() to restart the same track; nothing ended
+            return
+        self.track_ended = time.monotonic()
+        asyncio.run_coroutine_threadsafe(self.play_next(), loop)
+
+    def schedule_prefetch(self):
+        if self.prefetch_task and not self.prefetch_task.done():
             return
+        self.prefetch_task = asyncio.create_task(self.prefetch())
 
+    async def prefetch(self):
+        # Resolve the next few entries while the current track plays, so the
+        # hand-off in play_next skips extraction and can start from the cache
+        for idx in range(PREFETCH_DEPTH):
+            if self.is_exiting:
+                return
+            if idx >= len(self.queue):
+                break
+            song = self.queue[idx]
+            key = cache_key_for(song)
+            if key and audio_cache.contains(key):
+                continue
+            if not is_stream_fresh(song):
+                try:
+                    await resolve_stream(song)
+                    logging.info(f"Prefetched stream URL for {song.title}")
+                except yt_dlp.utils.DownloadError as e:
+                    logging.error(f"Failed to prefetch {song.title}: {str(e)}")
+                    continue
+            spawn_background(cache_song(song))
+        self.schedule_refresh()
+
+    def schedule_refresh(self):
+        # Long tracks or a long pause can outlast the URLs resolved for the next
+        # entries; prefetch runs again once the first of them is no longer fresh
+        if self.refresh_handle is not None:
+            self.refresh_handle.cancel()
+            self.refresh_handle = None
+        deadlines = [song.expires - (song.duration or 0) - STREAM_EXPIRY_MARGIN
+                     for song in itertools.islice(self.queue, PREFETCH_DEPTH)
+                     if is_stream_fresh(song) and not audio_cache.contains(cache_key_for(song) or "")]
+        if deadlines and not self.is_exiting:
+            # A second late, so is_stream_fresh already says no when it fires
+            delay = max(min(deadlines) - time.time() + 1, 0)
+            self.refresh_handle = asyncio.get_running_loop().call_later(delay, self.schedule_prefetch)
+
+    async def send_embed(self):
+        # Bursts of changes (bulk enqueues, loop toggles) are coalesced into one
+        # send/edit after EMBED_DEBOUNCE
+        self.embed_dirty = True
+        if self.embed_task is None or self.embed_task.done():
+            self.embed_task = asyncio.create_task(self._flush_embed())
+
+    async def _flush_embed(self):
+        while self.embed_dirty:
+            await asyncio.sleep(EMBED_DEBOUNCE)
+            self.embed_dirty = False
+            await self.update_embed()
+
+    def accept_press(self, user_id):
+        # Per-user debounce, checked before the press does any work
+        now = time.monotonic()
+        if now - self.last_presses.get(user_id, 0) < PRESS_DEBOUNCE:
+            return False
+        if len(self.last_presses) > 100:
+            self.last_presses = {uid: t for uid, t in self.last_presses.items() if now - t < PRESS_DEBOUNCE}
+        self.last_presses[user_id] = now
+        return True
+
+    def render_embed(self):
         embed = discord.Embed(title="🎵 Now Playing", color=discord.Color.from_rgb(29, 185, 84))
-        current_title = f"**🎶 {self.current['title']}**" if self.current else "*None*"
+        current_title = f"**🎶 {self.current.title}**" if self.current else "*None*"
         embed.description = current_title
-        duration = self.current.get("duration", 0) if self.current else 0
+        duration = self.current.duration if self.current else 0
         duration_text = str(timedelta(seconds=int(duration))) if duration and isinstance(duration, (int, float)) else "Unknown"
         embed.add_field(name="Duration", value=duration_text, inline=True)
         embed.add_field(name="Loop", value="🔁 Enabled" if self.loop else "Disabled", inline=True)
-        embed.set_thumbnail(url=self.current.get("thumbnail", "") if self.current else "")
-        
+        embed.set_thumbnail(url=self.current.thumbnail if self.current else "")
+
         if self.queue:
-            queue_text = ""
-            for idx, song in enumerate(self.queue, 1):
-                title = song.get("title", "Unknown title")
-                queue_text += f"*{idx}. {title}*\n"
-            embed.add_field(name="🎧 Up Next", value=queue_text[:1024], inline=False)
+            # Only the visible head of the queue is formatted, however long it is
+            lines = []
+            length = 0
+            for idx, song in enumerate(itertools.islice(self.queue, EMBED_QUEUE_LINES), 1):
+                line = f"*{idx}. {song.title or 'Unknown title'}*"
+                if length + len(line) + 1 > EMBED_FIELD_LIMIT - 32:
+                    break
+                lines.append(line)
+                length += len(line) + 1
+            remaining = len(self.queue) - len(lines)
+            if remaining:
+                lines.append(f"*…and {remaining} more*")
+            embed.add_field(name="🎧 Up Next", value="\n".join(lines), inline=False)
         else:
             embed.add_field(name="🎧 Up Next", value="*No songs in queue.*", inline=False)
+        return embed
+
+    async def update_embed(self):
+        if self.is_exiting or not self.text_channel:
+            return
+        if not self.text_channel.permissions_for(self.guild.me).send_messages:
+            logging.error(f"No permission to send embed in {self.text_channel.name}")
+            return
+
+        embed = self.render_embed()
+        rendered = embed.to_dict()
+        if self.message and rendered == self.last_rendered:
+            return
 
         try:
             if self.message:
                 await self.message.edit(embed=embed)
             else:
-                self.message = await self.text_channel.send(embed=embed)
-                for emoji in REACTS:
-                    await self.message.add_reaction(emoji)
+                self.message = await self.text_channel.send(embed=embed, view=player_controls)
+                player_messages[self.message.id] = self
+                message_ledger.record(self.message)
+            self.last_rendered = rendered
+        except discord.NotFound:
+            # The embed was deleted; the next update sends a fresh one
+            player_messages.pop(self.message.id, None)
+            self.message = None
+            self.last_rendered = None
         except discord.Forbidden:
             logging.error(f"No permission to send/edit embed in {self.text_channel.name}")
 
-async def ytdlp_search(query):
+async def resolve_concurrently(songs, concurrency=RESOLVE_CONCURRENCY):
+    # Yields (song, error) pairs in the order given while resolving them
+    # concurrently; a result that finishes early waits for those before it.
+    # The semaphore keeps one large list from occupying the whole extraction pool.
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def resolve_one(song):
+        async with semaphore:
+            try:
+                await resolve_stream(song)
+                return song, None
+            except yt_dlp.utils.DownloadError as e:
+                return song, e
+
+    tasks = [asyncio.create_task(resolve_one(song)) for song in songs]
+    try:
+        for task in tasks:
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def _extract_batches(query, opts, batch_size, emit, stop):
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        # process=False leaves playlist entries as a lazy generator, so pages
+        # are fetched only as the batches below are consumed
+        info = ydl.extract_info(query, download=False, process=False)
+        if info.get("_type", "video") != "playlist":
+            info = ydl.process_ie_result(info, download=False)
+        entries = info["entries"] if "entries" in info else [info]
+        batch = []
+        first = True
+        for entry in entries:
+            if stop.is_set():
+                return
+            if not entry:
+                continue
+            batch.append(Track.from_entry(entry))
+            # The first entry goes out alone so playback can start right away
+            if len(batch) >= (1 if first else batch_size):
+                emit(batch)
+                batch = []
+                first = False
+        if batch:
+            emit(batch)
+
+def _search_ttl(results):
+    # Results may carry stream URLs, so they are not reused past the first expiry
+    ttl = SEARCH_CACHE_TTL
+    expiries = [track.expires for track in results if track.expires]
+    if expiries:
+        ttl = min(ttl, min(expiries) - time.time() - STREAM_EXPIRY_MARGIN)
+    return ttl
+
+async def ytdlp_iter(query, batch_size=PLAYLIST_BATCH_SIZE):
+    # Yields lists of queue entries as they are extracted. Every caller gets its
+    # own Track objects, since queue entries are updated in place later.
+    cached = search_cache.get(query)
+    stats.inc("cache_lookups_total", cache="search", result="miss" if cached is None else "hit")
+    if cached is not None:
+        logging.info(f"Search cache hit for query: {query}")
+        for idx in range(0, len(cached), batch_size):
+            yield [Track.from_record(record) for record in cached[idx:idx + batch_size]]
+        return
+
     ydl_opts = {
         "format": "bestaudio/best",
         "quiet": True,
         "default_search": "auto",
         "noplaylist": False,
-        "download": False,
         "geo_bypass": True,
-        "extract_flat": False
+        "extract_flat": "in_playlist"
     }
-    loop = asyncio.get_event_loop()
+    loop = asyncio.get_running_loop()
+    batches = asyncio.Queue()
+    stop = threading.Event()
+    emit = lambda batch: loop.call_soon_threadsafe(batches.put_nowait, batch)
+    job = loop.run_in_executor(extract_executor, _extract_batches, query, ydl_opts, batch_size, emit, stop)
+    # Queued after every batch the job emitted, so it marks the end of the stream
+    job.add_done_callback(lambda _: batches.put_nowait(None))
+    results = []
+    started = time.perf_counter()
     try:
-        results = await loop.run_in_executor(None, lambda: _extract(query, ydl_opts))
-        logging.info(f"Extracted {len(results)} songs from query: {query}")
-        return results
-    except yt_dlp.utils.DownloadError as e:
-        logging.error(f"Error in ytdlp_search for query {query}: {str(e)}")
-        return []
-
-def _extract(query, opts):
-    with yt_dlp.YoutubeDL(opts) as ydl:
-        try:
-            info = ydl.extract_info(query, download=False)
-            if "entries" in info:
-                entries = info['entries']
-                logging.info(f"Found {len(entries)} entries in playlist for query: {query}")
-            else:
-                entries = [info]
-                logging.info(f"Single entry for query: {query}")
-            return [{"title": entry["title"], "url": entry["url"], "thumbnail": entry.get("thumbnail", ""), 
-                     "duration": entry.get("duration", 0), "webpage_url": entry.get("webpage_url", entry["url"])} 
-                    for entry in entries]
-        except yt_dlp.utils.DownloadError as e:
-            logging.error(f"Error extracting info for query {query}: {str(e)}")
-            return []
+        while True:
+            batch = await batches.get()
+            if batch is None:
+                break
+            if not results:
+                stats.observe("extract_seconds", time.perf_counter() - started, kind="search_first")
+            results.extend(batch)
+            yield [track.copy() for track in batch]
+        await job
+    except yt_dlp.utils.YoutubeDLError as e:
+        # DownloadError and the ExtractorErrors a lazy playlist page can raise
+        logging.error(f"Error extracting info for query {query}: {str(e)}")
+        return
+    except Exception as e:
+        logging.error(f"Unexpected error extracting info for query {query}: {type(e).__name__}: {str(e)}")
+        return
+    finally:
+        stop.set()
+        if not job.done():
+            # The consumer stopped early; the job returns at its next entry
+            try:
+                await job
+            except Exception:
+                pass
+    stats.observe("extract_seconds", time.perf_counter() - started, kind="search")
+    logging.info(f"Extracted {len(results)} songs from query: {query}")
+    if results:
+        search_cache.set(query, [track.to_record(with_stream=True) for track in results], _search_ttl(results))
 
 @tree.command(name="play", description="Play a song or playlist in your voice channel")
+@timed("/play")
 async def slash_play(interaction: discord.Interaction, query: str):
     try:
         await interaction.response.defer(ephemeral=True)
@@ -316,10 +1227,7 @@ async def slash_play(interaction: discord.Interaction, query: str):
             pass
         return
 
-    player = music_players.get(interaction.guild.id)
-    if not player:
-        player = MusicPlayer(interaction.guild)
-        music_players[interaction.guild.id] = player
+    player = await get_player(interaction.guild)
 
     if not player.voice_client or not player.voice_client.is_connected():
         try:
@@ -334,43 +1242,50 @@ async def slash_play(interaction: discord.Interaction, query: str):
             logging.error(f"Failed to connect to voice channel in guild {interaction.guild.id}")
             return
 
-    results = await ytdlp_search(query)
-    if not results:
+    player.text_channel = interaction.channel
+    player.bind_channels()
+    if player.woken:
+        # A woken player picks up where it stopped before anything new is queued
+        player.woken = False
+        if player.current:
+            await player.start_current(player.position_offset)
+    added = 0
+    queued_behind = False
+    async for batch in ytdlp_iter(query):
+        player.enqueue(batch)
+        if added == 0:
+            # Start on the first entry; the rest of a playlist streams in behind it
+            if not player.voice_client.is_playing() and not player.voice_client.is_paused():
+                await player.play_next()
+                await notifier.followup(interaction, f"▶️ Playing: {batch[0].title}")
+            elif player.voice_client.is_paused():
+                await player.resume()
+                try:
+                    await interaction.followup.send("▶️ Resumed playback.", ephemeral=True)
+                except discord.errors.NotFound:
+                    pass
+            else:
+                queued_behind = True
+        else:
+            player.schedule_prefetch()
+            await player.send_embed()
+        added += len(batch)
+
+    if not added:
         try:
             await interaction.followup.send("❌ No results found for the query.", ephemeral=True)
         except discord.errors.NotFound:
             pass
         return
 
-    for r in results:
-        player.queue.append(r)
-
-    player.text_channel = interaction.channel
-    if not player.voice_client.is_playing() and not player.voice_client.is_paused():
-        await player.play_next()
-        try:
-            msg = await interaction.followup.send(f"▶️ Playing: {results[0]['title']}", ephemeral=True)
-            await asyncio.sleep(5)
-            await msg.delete()
-        except (discord.errors.NotFound, discord.Forbidden):
-            pass
-    elif player.voice_client.is_paused():
-        player.voice_client.resume()
-        try:
-            await interaction.followup.send("▶️ Resumed playback.", ephemeral=True)
-        except discord.errors.NotFound:
-            pass
-    else:
-        try:
-            msg = await interaction.followup.send(f"🎶 Added {len(results)} song(s) to queue.", ephemeral=True)
-            await asyncio.sleep(5)
-            await msg.delete()
-        except (discord.errors.NotFound, discord.Forbidden):
-            pass
+    if queued_behind or added > 1:
+        await notifier.followup(interaction, f"🎶 Added {added} song(s) to queue.")
     
+    player.schedule_prefetch()
     await player.send_embed()
 
 @tree.command(name="fav", description="Play your favorite songs")
+@timed("/fav")
 async def slash_fav(interaction: discord.Interaction):
     try:
         await interaction.response.defer(ephemeral=True)
@@ -401,10 +1316,7 @@ async def slash_fav(interaction: discord.Interaction):
             pass
         return
 
-    player = music_players.get(interaction.guild.id)
-    if not player:
-        player = MusicPlayer(interaction.guild)
-        music_players[interaction.guild.id] = player
+    player = await get_player(interaction.guild)
 
     if not player.voice_client or not player.voice_client.is_connected():
         try:
@@ -419,7 +1331,7 @@ async def slash_fav(interaction: discord.Interaction):
             logging.error(f"Failed to connect to voice channel in guild {interaction.guild.id}")
             return
 
-    favorites = get_favorites(interaction.user.id)
+    favorites = [favorite async for favorite in favorites_store.iter_favorites(interaction.user.id)]
     if not favorites:
         try:
             await interaction.followup.send("❌ You have no favorite songs.", ephemeral=True)
@@ -427,70 +1339,241 @@ async def slash_fav(interaction: discord.Interaction):
             pass
         return
 
-    # Re-extract favorites to get streamable URLs
-    for song in favorites:
-        ydl_opts = {"format": "bestaudio/best", "quiet": True, "geo_bypass": True}
-        try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(song['url'], download=False)
-                player.queue.append({
-                    "title": song['title'],
-                    "url": info['url'],
-                    "thumbnail": song['thumbnail'],
-                    "duration": info.get('duration', 0),
-                    "webpage_url": song['url']
-                })
-        except yt_dlp.utils.DownloadError as e:
-            logging.error(f"Failed to extract favorite song {song['title']}: {str(e)}")
+    player.text_channel = interaction.channel
+    player.bind_channels()
+    if player.woken:
+        # A woken player picks up where it stopped before anything new is queued
+        player.woken = False
+        if player.current:
+            await player.start_current(player.position_offset)
+    # Resolve favorites concurrently, queue them in saved order and start on
+    # the first one that succeeds
+    songs = [Track(favorite['title'], favorite['url'], favorite['thumbnail']) for favorite in favorites]
+    added = 0
+    queued_behind = False
+    failed = []
+    async for song, error in resolve_concurrently(songs):
+        if error:
+            logging.error(f"Failed to extract favorite song {song.title}: {str(error)}")
+            failed.append(song.title)
             continue
+        player.enqueue([song])
+        added += 1
+        if added > 1:
+            continue
+        if not player.voice_client.is_playing() and not player.voice_client.is_paused():
+            await player.play_next()
+            await notifier.followup(interaction, f"▶️ Playing favorite: {song.title}")
+        else:
+            queued_behind = True
 
-    player.text_channel = interaction.channel
-    if not player.voice_client.is_playing() and not player.voice_client.is_paused():
-        await player.play_next()
-        try:
-            msg = await interaction.followup.send(f"▶️ Playing favorite: {favorites[0]['title']}", ephemeral=True)
-            await asyncio.sleep(5)
-            await msg.delete()
-        except (discord.errors.NotFound, discord.Forbidden):
-            pass
-    else:
+    if queued_behind or added > 1:
+        await notifier.followup(interaction, f"🎶 Added {added} favorite song(s) to queue.")
+
+    if failed:
+        summary = ", ".join(failed)
+        if len(summary) > 1500:
+            summary = summary[:1500] + "…"
         try:
-            msg = await interaction.followup.send(f"🎶 Added {len(favorites)} favorite song(s) to queue.", ephemeral=True)
-            await asyncio.sleep(5)
-            await msg.delete()
-        except (discord.errors.NotFound, discord.Forbidden):
+            await interaction.followup.send(f"⚠️ Couldn't load {len(failed)} of {len(songs)} favorite song(s): {summary}", ephemeral=True)
+        except discord.errors.NotFound:
             pass
 
+    if not added:
+        return
+
+    player.schedule_prefetch()
     await player.send_embed()
 
-@bot.event
-async def on_reaction_add(reaction, user):
-    if user.bot or reaction.message.author != bot.user:
+async def queue_player(interaction):
+    # Defers the interaction and returns the guild's player, or None (after
+    # telling the user) when there is no queue to act on
+    try:
+        await interaction.response.defer(ephemeral=True)
+    except discord.errors.NotFound:
+        logging.error(f"Failed to defer interaction for /{interaction.command.name} in guild {interaction.guild.id}")
+        return None
+    player = music_players.get(interaction.guild.id)
+    if player is None or player.is_exiting or not player.queue:
+        await notifier.followup(interaction, "❌ The queue is empty.")
+        return None
+    return player
+
+async def queue_changed(player):
+    player.schedule_prefetch()
+    await player.send_embed()
+
+@tree.command(name="remove", description="Remove a song from the queue")
+@app_commands.describe(position="Position in the queue, starting at 1")
+@timed("/remove")
+async def slash_remove(interaction: discord.Interaction, position: app_commands.Range[int, 1]):
+    player = await queue_player(interaction)
+    if player is None:
         return
-    for player in music_players.values():
-        if player.message and reaction.message.id == player.message.id:
-            if str(reaction.emoji) not in REACTS:
-                try:
-                    await reaction.message.remove_reaction(reaction.emoji, user)
-                except discord.Forbidden:
-                    pass
-                return
-            action = REACTS.get(str(reaction.emoji))
-            if action:
-                await handle_action(action, player, user, reaction.message)
-                try:
-                    await reaction.message.remove_reaction(reaction.emoji, user)
-                except discord.Forbidden:
-                    pass
+    if position > len(player.queue):
+        await notifier.followup(interaction, f"❌ The queue has {len(player.queue)} song(s).")
+        return
+    song = player.queue.pop(position - 1)
+    player.journal("remove", position - 1)
+    await queue_changed(player)
+    await notifier.followup(interaction, f"🗑️ Removed: {song.title}")
+
+@tree.command(name="move", description="Move a song to another place in the queue")
+@app_commands.describe(source="Position of the song, starting at 1", destination="Position to move it to")
+@timed("/move")
+async def slash_move(interaction: discord.Interaction, source: app_commands.Range[int, 1],
+                     destination: app_commands.Range[int, 1]):
+    player = await queue_player(interaction)
+    if player is None:
+        return
+    if source > len(player.queue):
+        await notifier.followup(interaction, f"❌ The queue has {len(player.queue)} song(s).")
+        return
+    destination = min(destination, len(player.queue))
+    player.queue.move(source - 1, destination - 1)
+    player.journal("move", source - 1, destination - 1)
+    await queue_changed(player)
+    await notifier.followup(interaction, f"↕️ Moved {player.queue[destination - 1].title} to position {destination}.")
+
+@tree.command(name="jump", description="Skip ahead to a song in the queue")
+@app_commands.describe(position="Position in the queue, starting at 1")
+@timed("/jump")
+async def slash_jump(interaction: discord.Interaction, position: app_commands.Range[int, 1]):
+    player = await queue_player(interaction)
+    if player is None:
+        return
+    if position > len(player.queue):
+        await notifier.followup(interaction, f"❌ The queue has {len(player.queue)} song(s).")
+        return
+    if player.loop and player.current and not player.requeued:
+        # The rotation continues with the current track, then the skipped ones
+        player.queue.append(player.current)
+        player.journal("extend", [track_record(player.current)])
+        player.requeued = True
+    skipped = player.queue.take_front(position - 1)
+    if player.loop:
+        player.queue.extend_queue(skipped)
+    player.journal("jump", position - 1)
+    await notifier.followup(interaction, f"⏭️ Jumping to: {player.queue[0].title}")
+    if player.voice_client and (player.voice_client.is_playing() or player.voice_client.is_paused()):
+        # play_next runs from the stopped track's after callback
+        player.voice_client.stop()
+    elif player.voice_client and player.voice_client.is_connected():
+        await player.play_next()
+    else:
+        await queue_changed(player)
+
+@tree.command(name="shuffle", description="Shuffle the queue")
+@timed("/shuffle")
+async def slash_shuffle(interaction: discord.Interaction):
+    player = await queue_player(interaction)
+    if player is None:
+        return
+    player.queue.shuffle()
+    player.checkpoint()
+    await queue_changed(player)
+    await notifier.followup(interaction, f"🔀 Shuffled {len(player.queue)} song(s).")
+
+def parse_timestamp(text):
+    # Seconds from "90", "1:30" or "1:02:30", or None when it is none of those
+    parts = text.strip().split(":")
+    if not 1 <= len(parts) <= 3:
+        return None
+    try:
+        values = [float(part) if idx == len(parts) - 1 else int(part) for idx, part in enumerate(parts)]
+    except ValueError:
+        return None
+    # float() also takes "nan" and "inf"
+    if not all(math.isfinite(value) for value in values):
+        return None
+    if any(value < 0 for value in values) or any(value >= 60 for value in values[1:]):
+        return None
+    seconds = 0
+    for value in values:
+        seconds = seconds * 60 + value
+    return seconds
+
+async def playing_player(interaction):
+    # Defers the interaction and returns the guild's player, or None (after
+    # telling the user) when nothing is loaded on a live connection
+    try:
+        await interaction.response.defer(ephemeral=True)
+    except discord.errors.NotFound:
+        logging.error(f"Failed to defer interaction for /{interaction.command.name} in guild {interaction.guild.id}")
+        return None
+    player = music_players.get(interaction.guild.id)
+    if (player is None or player.is_exiting or not player.current
+            or not player.voice_client or not player.voice_client.is_connected()):
+        await notifier.followup(interaction, "❌ Nothing is playing.")
+        return None
+    return player
+
+async def restart_at(interaction, player, position):
+    try:
+        await player.seek(position)
+    except (yt_dlp.utils.DownloadError, discord.ClientException, OSError) as e:
+        logging.error(f"Failed to restart {player.current.title} at {position}s: {str(e)}")
+        await notifier.followup(interaction, f"❌ Failed to restart {player.current.title}.")
+        return False
+    return True
+
+@tree.command(name="seek", description="Jump to a point in the current song")
+@app_commands.describe(position="Time from the start of the song, e.g. 90 or 1:30")
+@timed("/seek")
+async def slash_seek(interaction: discord.Interaction, position: str):
+    player = await playing_player(interaction)
+    if player is None:
+        return
+    seconds = parse_timestamp(position)
+    if seconds is None:
+        await notifier.followup(interaction, "❌ Give the time as seconds or minutes:seconds, e.g. 90 or 1:30.")
+        return
+    duration = player.current.duration
+    if duration and seconds >= duration:
+        await notifier.followup(interaction, f"❌ {player.current.title} is only {timedelta(seconds=int(duration))} long.")
+        return
+    was_paused = player.voice_client.is_paused()
+    if await restart_at(interaction, player, seconds):
+        resumed = "\n▶️ Resumed playback." if was_paused else ""
+        await notifier.followup(interaction, f"⏩ Jumped to {timedelta(seconds=int(seconds))} in {player.current.title}.{resumed}")
+
+@tree.command(name="replay", description="Play the current song again from the start")
+@timed("/replay")
+async def slash_replay(interaction: discord.Interaction):
+    player = await playing_player(interaction)
+    if player is None:
+        return
+    was_paused = player.voice_client.is_paused()
+    if await restart_at(interaction, player, 0):
+        resumed = "\n▶️ Resumed playback." if was_paused else ""
+        await notifier.followup(interaction, f"🔁 Replaying: {player.current.title}{resumed}")
+
+class PlayerControls(discord.ui.View):
+    # Persistent view: no timeout and fixed custom ids, so buttons on embeds
+    # sent before a restart keep working once it is registered again
+    def __init__(self):
+        super().__init__(timeout=None)
+        for emoji, action in REACTS.items():
+            button = discord.ui.Button(emoji=emoji, style=discord.ButtonStyle.secondary, custom_id=f"music:{action}")
+            button.callback = functools.partial(self.press, action)
+            self.add_item(button)
+
+    async def press(self, action, interaction):
+        player = player_messages.get(interaction.message.id) or music_players.get(interaction.guild_id)
+        if not player:
+            await interaction.response.send_message("❌ Nothing is playing in this server.", ephemeral=True)
+            return
+        # The acknowledgement is the only REST call a press needs
+        await interaction.response.defer()
+        if player.accept_press(interaction.user.id):
+            with timing(f"button:{action}"):
+                await handle_action(action, player, interaction.user, interaction.message)
+
+player_controls = None  # Created in setup_hook, views need the running loop
 
 async def handle_action(action, player, user, message):
     if not user.voice or not user.voice.channel:
-        try:
-            msg = await player.text_channel.send("❌ You must be in a voice channel.", ephemeral=True)
-            await asyncio.sleep(5)
-            await msg.delete()
-        except discord.Forbidden:
-            logging.error(f"No permission to send message in {player.text_channel.name}")
+        notifier.notify(player.text_channel, "❌ You must be in a voice channel.")
         return
 
     if not player.text_channel.permissions_for(player.guild.me).send_messages:
@@ -498,6 +1581,9 @@ async def handle_action(action, player, user, message):
         return
 
     if action == "prev":
+        if not player.voice_client or not player.voice_client.is_connected():
+            notifier.notify(player.text_channel, "❌ Not connected to a voice channel.")
+            return
         if player.loop and not player.previous and player.queue:
             player.previous = player.current
             player.current = player.queue.pop()
@@ -508,51 +1594,33 @@ async def handle_action(action, player, user, message):
             player.previous = None
         else:
             return
-        if player.voice_client:
-            try:
-                await player.voice_client.disconnect()
-            except discord.ClientException:
-                pass
+        player.checkpoint()
+        was_paused = player.voice_client.is_paused()
+        # Swapped in on the existing connection, no voice reconnect
         try:
-            player.voice_client = await user.voice.channel.connect()
-            await player.play_next()
-        except discord.Forbidden:
-            try:
-                await player.text_channel.send("❌ Bot lacks permission to join the voice channel.", ephemeral=True)
-            except discord.Forbidden:
-                pass
-        except discord.ClientException:
-            logging.error(f"Failed to reconnect to voice channel in guild {player.guild.id}")
+            await player.seek(0)
+        except (yt_dlp.utils.DownloadError, discord.ClientException, OSError) as e:
+            logging.error(f"Failed to restart {player.current.title}: {str(e)}")
+            notifier.notify(player.text_channel, f"❌ Failed to play {player.current.title}.")
+            return
+        if was_paused:
+            notifier.notify(player.text_channel, "▶️ Resumed playback.")
 
     elif action == "resume":
         if player.voice_client.is_paused():
-            player.voice_client.resume()
-            try:
-                msg = await player.text_channel.send("▶️ Resumed playback.")
-                await asyncio.sleep(5)
-                await msg.delete()
-            except discord.Forbidden:
-                logging.error(f"No permission to send message in {player.text_channel.name}")
+            await player.resume()
+            notifier.notify(player.text_channel, "▶️ Resumed playback.")
         elif not player.voice_client.is_playing():
             await player.play_next()
 
     elif action == "stop":
         if player.voice_client.is_playing():
             player.voice_client.pause()
+            player.mark_paused()
             await player.send_embed()
-            try:
-                msg = await player.text_channel.send("⏹️ Stopped playback.")
-                await asyncio.sleep(5)
-                await msg.delete()
-            except discord.Forbidden:
-                logging.error(f"No permission to send message in {player.text_channel.name}")
+            notifier.notify(player.text_channel, "⏹️ Stopped playback.")
         else:
-            try:
-                msg = await player.text_channel.send("⏹️ No song currently playing.")
-                await asyncio.sleep(5)
-                await msg.delete()
-            except discord.Forbidden:
-                logging.error(f"No permission to send message in {player.text_channel.name}")
+            notifier.notify(player.text_channel, "⏹️ No song currently playing.")
 
     elif action == "skip":
         if player.voice_client:
@@ -560,20 +1628,18 @@ async def handle_action(action, player, user, message):
 
     elif action == "loop":
         player.loop = not player.loop
+        player.journal("loop", player.loop)
         await player.send_embed()
 
     elif action == "fav":
         if player.current:
-            add_favorite(user.id, player.current['title'], player.current['webpage_url'], player.current.get('thumbnail', ''))
-            try:
-                msg = await player.text_channel.send(f"⭐ Added to favorites: {player.current['title']}")
-                await asyncio.sleep(5)
-                await msg.delete()
-            except discord.Forbidden:
-                logging.error(f"No permission to send message in {player.text_channel.name}")
+            favorites_store.add(user.id, player.current.title, player.current.webpage_url, player.current.thumbnail)
+            notifier.notify(player.text_channel, f"⭐ Added to favorites: {player.current.title}")
 
     elif action == "exit":
         player.is_exiting = True
+        if player.refresh_handle is not None:
+            player.refresh_handle.cancel()
         if player.voice_client:
             if player.voice_client.is_playing() or player.voice_client.is_paused():
                 player.voice_client.stop()
@@ -585,43 +1651,352 @@ async def handle_action(action, player, user, message):
         player.current = None
         player.previous = None
         player.skip_attempts.clear()
-        try:
-            async for msg in player.text_channel.history(limit=100):
-                if msg.author.id == bot.user.id:
-                    await msg.delete()
-        except discord.Forbidden:
-            logging.error(f"No permission to delete messages in {player.text_channel.name} ({player.guild.id})")
-        except discord.HTTPException as e:
-            logging.error(f"Failed to delete messages: {str(e)}")
+        if player.text_channel:
+            # Only the messages the ledger knows about, in this player's channel
+            sent = await message_ledger.messages_by_channel(player.text_channel.id)
+            await purge_messages(player.text_channel.id, sent.get(player.text_channel.id, []))
         music_players.pop(player.guild.id, None)
-        try:
-            msg = await player.text_channel.send("❌ Bot exited voice channel.")
-            await asyncio.sleep(5)
-            await msg.delete()
-        except discord.Forbidden:
-            logging.error(f"No permission to send message in {player.text_channel.name}")
+        queue_journal.discard(player.guild.id)
+        if player.message:
+            player_messages.pop(player.message.id, None)
+        notifier.notify(player.text_channel, "❌ Bot exited voice channel.")
         logging.info(f"Bot exited voice channel in guild {player.guild.id}")
 
+# Queue restore
+def player_from_state(guild, state):
+    # Registers a player rebuilt from a replayed journal, or returns None for an empty one
+    if not state["current"] and not state["queue"]:
+        queue_journal.discard(guild.id)
+        return None
+    player = MusicPlayer(guild)
+    # Journaled tracks carry no stream URL; it is resolved when the track nears the head
+    player.queue.extend(Track.from_record(record) for record in state["queue"])
+    player.current = Track.from_record(state["current"]) if state["current"] else None
+    player.previous = Track.from_record(state["previous"]) if state["previous"] else None
+    player.loop = state["loop"]
+    player.position_offset = state["position"]
+    player.text_channel = guild.get_channel(state["text_channel"]) if state["text_channel"] else None
+    # Whoever starts it first resumes the restored track rather than advancing past it
+    player.woken = True
+    music_players[guild.id] = player
+    # Start the journal afresh; this also drops a torn line left by a crash
+    player.checkpoint()
+    return player
+
+async def restore_player(guild):
+    # Rebuilds a guild's player from its journal and picks up where it left off.
+    # Only the current track is resolved now; the rest resolves as it comes up.
+    state = await queue_journal.load(guild.id)
+    if state is None or guild.id in music_players:
+        return
+    if state["hibernated"]:
+        # It was idle when the bot stopped; it comes back with the guild's next /play or /fav
+        hibernated.add(guild.id)
+        return
+    player = player_from_state(guild, state)
+    if player is None:
+        return
+
+    voice_channel = guild.get_channel(state["voice_channel"]) if state["voice_channel"] else None
+    if voice_channel is None or not voice_channel.permissions_for(guild.me).connect:
+        logging.info(f"Restored queue for guild {guild.id} without rejoining voice")
+        return
+    try:
+        player.voice_client = await voice_channel.connect()
+    except (discord.ClientException, asyncio.TimeoutError) as e:
+        logging.error(f"Failed to rejoin voice channel in guild {guild.id}: {str(e)}")
+        return
+    logging.info(f"Restored queue for guild {guild.id}: {len(player.queue)} queued, resuming at {player.position_offset:.0f}s")
+    player.woken = False
+    if player.current:
+        await player.start_current(player.position_offset)
+    else:
+        await player.play_next()
+
+async def get_player(guild):
+    # The guild's player, woken from the journal if it was hibernated, else a new one
+    if guild.id not in music_players and guild.id in hibernated:
+        hibernated.discard(guild.id)
+        state = await queue_journal.load(guild.id)
+        if state is not None and guild.id not in music_players:
+            if player_from_state(guild, state) is not None:
+                logging.info(f"Woke hibernated player in guild {guild.id}")
+    player = music_players.get(guild.id)
+    if player is None:
+        player = music_players[guild.id] = MusicPlayer(guild)
+    return player
+
+async def checkpoint_positions():
+    # Journals where each playing track is, so a restart resumes close to it
+    while True:
+        await asyncio.sleep(POSITION_CHECKPOINT)
+        for player in list(music_players.values()):
+            try:
+                if player.current and player.position_started is not None and not player.is_exiting:
+                    player.journal("position", round(player.playback_position(), 2))
+            except Exception as e:
+                logging.error(f"Failed to checkpoint position in guild {player.guild.id}: {str(e)}")
+
 @bot.event
-async def on_ready():
-    init_db()
-    ensure_cache_dir()
-    await tree.sync()
-    print(f"✅ {bot.user} is ready and commands are synced.")
-    logging.info(f"Bot {bot.user} started")
-    for guild in bot.guilds:
-        for channel in guild.text_channels:
-            if not channel.permissions_for(guild.me).read_message_history:
-                continue
-            if not channel.permissions_for(guild.me).manage_messages:
+async def on_guild_available(guild):
+    # Fires as each guild streams in after connecting, so restores are spread
+    # out with the guilds instead of all running at startup
+    if guild.id in pending_restores:
+        pending_restores.discard(guild.id)
+        spawn_background(restore_player(guild))
+
+# Idle players
+async def hibernate_player(player, reason):
+    # Frees a player nobody is using: leaves voice and drops it from memory.
+    # The queue stays in the journal with its resolved stream URLs, so the
+    # guild's next /play or /fav resumes it without extracting again.
+    guild_id = player.guild.id
+    if music_players.get(guild_id) is not player or player.is_exiting:
+        return
+    player.is_exiting = True
+    player.position_offset = player.playback_position()
+    player.position_started = None
+    state = player.snapshot(with_streams=True)
+    state["hibernated"] = True
+    queue_journal.compact(guild_id, state)
+    music_players.pop(guild_id, None)
+    hibernated.add(guild_id)
+    for task in (player.prefetch_task, player.embed_task):
+        if task is not None and not task.done():
+            task.cancel()
+    if player.refresh_handle is not None:
+        player.refresh_handle.cancel()
+    if player.voice_client:
+        if player.voice_client.is_playing() or player.voice_client.is_paused():
+            player.voice_client.stop()
+        try:
+            await player.voice_client.disconnect()
+        except discord.ClientException:
+            pass
+    if player.message:
+        player_messages.pop(player.message.id, None)
+        if player.text_channel:
+            await purge_messages(player.text_channel.id, [player.message.id])
+    notifier.notify(player.text_channel, "💤 Left the voice channel while idle. /play or /fav picks up where it stopped.", ttl=60)
+    logging.info(f"Hibernated player in guild {guild_id} ({reason}): {len(player.queue)} queued")
+
+async def reap_idle_players():
+    # Hibernates players that have been paused, stopped, alone or out of
+    # voice for IDLE_TIMEOUT
+    while True:
+        await asyncio.sleep(REAPER_INTERVAL)
+        now = time.monotonic()
+        for player in list(music_players.values()):
+            if player.is_exiting:
                 continue
+            # One player failing to leave (e.g. an HTTPException while purging
+            # its embed) must not stop the sweep for every other guild
             try:
-                async for msg in channel.history(limit=50):
-                    if msg.author.id == bot.user.id:
-                        await msg.delete()
-            except discord.Forbidden:
-                print(f"❌ No permission to delete in {channel.name} ({channel.id})")
-            except discord.HTTPException as e:
-                print(f"⚠️ Failed to delete messages: {e}")
+                if player.is_active():
+                    player.idle_since = None
+                elif player.idle_since is None:
+                    player.idle_since = now
+                elif now - player.idle_since >= IDLE_TIMEOUT:
+                    await hibernate_player(player, "idle")
+            except Exception as e:
+                logging.error(f"Failed to hibernate idle player in guild {player.guild.id}: {str(e)}")
+
+async def voice_lost(player):
+    # Disconnects that are part of a reconnect are followed by a new
+    # connection within the grace period; anything else frees the player
+    await asyncio.sleep(VOICE_LOST_GRACE)
+    if not player.voice_client or not player.voice_client.is_connected():
+        await hibernate_player(player, "left voice")
+
+@bot.event
+async def on_voice_state_update(member, before, after):
+    player = music_players.get(member.guild.id)
+    if player is None or player.is_exiting or before.channel == after.channel:
+        return
+    if member.id == bot.user.id:
+        if after.channel is None:
+            # Kicked, or the channel was deleted
+            spawn_background(voice_lost(player))
+        return
+    channel = player.voice_client.channel if player.voice_client else None
+    if channel is None or channel not in (before.channel, after.channel) or member.bot:
+        return
+    listeners = player.listeners()
+    if not listeners and player.voice_client.is_playing():
+        player.voice_client.pause()
+        player.mark_paused()
+        player.auto_paused = True
+        player.idle_since = time.monotonic()
+        notifier.notify(player.text_channel, "⏸️ Paused, everyone left the voice channel.")
+        await player.send_embed()
+    elif listeners and player.auto_paused and player.voice_client.is_paused():
+        await player.resume()
+        player.idle_since = None
+        notifier.notify(player.text_channel, "▶️ Resumed playback.")
+
+# Application command sync
+COMMAND_TREE_HASH_KEY = "command_tree_hash"
+
+def command_tree_hash():
+    # Digest of the exact payload tree.sync() would upload, plus the application
+    # it goes to, so switching tokens also counts as a change
+    payload = sorted((cmd.to_dict(tree) for cmd in tree.get_commands()), key=lambda c: (c["type"], c["name"]))
+    blob = json.dumps({"application_id": bot.application_id, "commands": payload},
+                      sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+async def sync_commands(force=False):
+    # tree.sync() is a slow global call with a tight rate limit; only make it
+    # when the registered commands differ from what was last uploaded
+    digest = command_tree_hash()
+    if not force and await settings_store.get(COMMAND_TREE_HASH_KEY) == digest:
+        logging.info("Application commands unchanged, skipping sync")
+        return None
+    synced = await tree.sync()
+    await settings_store.set(COMMAND_TREE_HASH_KEY, digest)
+    logging.info(f"Synced {len(synced)} application commands")
+    return synced
+
+@bot.command(name="sync")
+@commands.is_owner()
+async def force_sync(ctx):
+    # Escape hatch for when Discord's copy of the commands drifted, e.g. after
+    # they were edited from another process or the developer portal. Under
+    # MINIMAL_INTENTS the bot cannot read message content, so only the mention
+    # form ("@Bot sync") reaches it; a bare "!sync" works with MINIMAL_INTENTS=0.
+    try:
+        synced = await sync_commands(force=True)
+    except discord.HTTPException as e:
+        logging.error(f"Forced command sync failed: {str(e)}")
+        notifier.notify(ctx.channel, f"❌ Command sync failed: {e}")
+        return
+    notifier.notify(ctx.channel, f"✅ Synced {len(synced)} commands.")
+
+# Memory report
+startup_rss = None  # Resident size before the gateway connected
+
+def memory_report():
+    rss = resident_memory()
+    shard_ids = sorted(bot.shards) if AUTO_SHARD else [None]
+    lines = [
+        f"Mode: {'sharded' if AUTO_SHARD else 'single'}, {'minimal' if MINIMAL_INTENTS else 'all'} intents",
+        f"Resident: {format_bytes(rss)} (startup {format_bytes(startup_rss)})",
+    ]
+    if rss is not None and len(shard_ids) > 1:
+        # The process shares one heap, so this is an average, not a measurement per shard
+        lines.append(f"Resident per shard (average): {format_bytes(rss / len(shard_ids))}")
+    for shard_id in shard_ids:
+        guilds = [guild for guild in bot.guilds if shard_id is None or guild.shard_id == shard_id]
+        members = sum(len(guild.members) for guild in guilds)
+        latency = bot.shards[shard_id].latency if shard_id is not None else bot.latency
+        label = "Shard" if shard_id is None else f"Shard {shard_id}"
+        lines.append(f"{label}: {len(guilds)} guilds, {members} cached members, {latency * 1000:.0f} ms")
+    return lines
+
+def collect_metrics():
+    # Point-in-time gauges, read when the metrics endpoint is scraped
+    voice_clients = [player.voice_client for player in music_players.values() if player.voice_client]
+    playing = [vc for vc in voice_clients if vc.is_playing()]
+    stats.set_gauge("players", len(music_players))
+    stats.set_gauge("players_playing", len(playing))
+    stats.set_gauge("players_hibernated", len(hibernated))
+    stats.set_gauges("queue_length", {(("guild", guild_id),): len(player.queue)
+                                      for guild_id, player in music_players.items()})
+    stats.set_gauge("guilds", len(bot.guilds))
+    stats.set_gauge("cache_bytes", audio_cache.total_size)
+    stats.set_gauge("cache_max_bytes", audio_cache.max_size)
+    # A paused FFmpeg source keeps its process alive, so paused clients count too
+    stats.set_gauge("ffmpeg_processes", sum(isinstance(vc.source, discord.FFmpegAudio) for vc in voice_clients), kind="playback")
+    if voice_pool is not None:
+        stats.set_gauge("ffmpeg_processes", sum(len(worker.streams) for worker in voice_pool.workers), kind="worker")
+    stats.set_gauge("resident_bytes", resident_memory() or 0)
+    stats.set_gauge("loop_lag_last_seconds", loop_monitor.last_lag)
+
+def stats_report():
+    snapshot = stats.snapshot()
+    lines = [f"Loop lag: last {loop_monitor.last_lag * 1000:.0f} ms"]
+    for (name, labels), summary in sorted(snapshot["histograms"].items()):
+        label = ",".join(f"{key}={val}" for key, val in labels)
+        lines.append(f"{name}{{{label}}}: n={summary['count']} mean={summary['mean'] * 1000:.0f}ms "
+                     f"p50≤{summary['p50'] * 1000:.0f}ms p99≤{summary['p99'] * 1000:.0f}ms max={summary['max'] * 1000:.0f}ms")
+    for (name, labels), value in sorted(snapshot["counters"].items()) + sorted(snapshot["gauges"].items()):
+        label = ",".join(f"{key}={val}" for key, val in labels)
+        lines.append(f"{name}{{{label}}}: {value}")
+    return lines
+
+@bot.command(name="stats")
+@commands.is_owner()
+async def show_stats(ctx):
+    notifier.notify(ctx.channel, "\n".join(stats_report()), ttl=60)
+
+@bot.command(name="memory")
+@commands.is_owner()
+async def show_memory(ctx):
+    notifier.notify(ctx.channel, "\n".join(memory_report()), ttl=60)
+
+@bot.event
+async def setup_hook():
+    # Registered once per process, before the gateway connects. on_ready fires
+    # again after every reconnect, so one-off startup work belongs here.
+    global player_controls, startup_rss
+    startup_rss = resident_memory()
+    loop_monitor.start()
+    instrument_http(bot.http)
+    if METRICS_PORT:
+        try:
+            await start_metrics_server(METRICS_HOST, METRICS_PORT, METRICS_PREFIX, collect_metrics)
+        except OSError as e:
+            logging.error(f"Failed to start metrics endpoint on port {METRICS_PORT}: {str(e)}")
+    player_controls = PlayerControls()
+    bot.add_view(player_controls)
+    await favorites_store.open()
+    await message_ledger.open()
+    if voice_pool is not None:
+        await asyncio.get_running_loop().run_in_executor(None, voice_pool.start)
+    try:
+        await sync_commands()
+    except discord.HTTPException as e:
+        logging.error(f"Failed to sync application commands: {str(e)}")
+    # REST only, so it does not have to wait for the guild cache
+    spawn_background(purge_ledger())
+    pending_restores.update(queue_journal.guild_ids())
+    spawn_background(checkpoint_positions())
+    spawn_background(reap_idle_players())
+    spawn_background(flush_cache_access())
+
+bot_close = bot.close
+
+async def close():
+    # Client.close() disconnects every voice client, which ends the playing
+    # tracks; exiting players do not advance, so the journal keeps them as
+    # current. Then everything still buffered is written before shutting down.
+    for player in list(music_players.values()):
+        if not player.is_exiting and player.current and player.position_started is not None:
+            player.journal("position", round(player.playback_position(), 2))
+        player.is_exiting = True
+    try:
+        await queue_journal.flush()
+        await favorites_store.close()
+        try:
+            # The download pool may be busy with downloads; the cache takes its own lock
+            await asyncio.get_running_loop().run_in_executor(None, audio_cache.flush_access)
+        except sqlite3.Error as e:
+            logging.error(f"Failed to write cache access times: {str(e)}")
+    finally:
+        await bot_close()
+
+bot.close = close
+
+@bot.event
+async def on_ready():
+    print(f"✅ {bot.user} is ready.")
+    logging.info(f"Bot {bot.user} started")
+    for line in memory_report():
+        logging.info(line)
+
+@bot.event
+async def on_shard_ready(shard_id):
+    logging.info(f"Shard {shard_id} ready, resident {format_bytes(resident_memory())}")
 
-bot.run(TOKEN)
\ No newline at end of file
+if __name__ == "__main__":
+    bot.run(TOKEN)
@@ -0,0 +1,289 @@
+import os
+import json
+import sqlite3
+import threading
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+INDEX_NAME = "index.db"
+TEMP_SUFFIX = ".part"
+METADATA_PRUNE_INTERVAL = 600  # Seconds between deletes of expired metadata rows
+STRAY_FILE_AGE = 3600  # Seconds before an unindexed file counts as abandoned; younger ones may be another process's download
+
+
+class AudioCache:
+    # Content-addressed audio cache. Files are named after a digest of
+    # extractor + video id, and a SQLite index tracks size, last access and hits
+    # so size accounting never needs a directory walk. Several processes (one
+    # per slice of shards) may share a directory: temp files carry the pid,
+    # and the size is re-read from the shared index before evicting.
+    def __init__(self, directory, max_size, low_water=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.low_water = low_water if low_water is not None else int(max_size * 0.8)
+        self._lock = threading.Lock()
+        self._accessed = {}  # key -> [last access, hits] not yet written to the index
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(directory, INDEX_NAME), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS tracks
+                              (key TEXT PRIMARY KEY, filename TEXT NOT NULL, size INTEGER NOT NULL,
+                               last_access REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0)''')
+        self._conn.execute("CREATE INDEX IF NOT EXISTS tracks_last_access ON tracks (last_access)")
+        self._conn.commit()
+        self.total_size = self._reconcile()
+
+    @staticmethod
+    def key_for(extractor, video_id):
+        if not extractor or not video_id:
+            return None
+        return f"{extractor.lower()}:{video_id}"
+
+    @staticmethod
+    def _basename(key):
+        # Hex digests keep ids that differ only by case apart on case-insensitive filesystems
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def _path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def _reconcile(self):
+        # Drop index rows whose file vanished, and files the index does not know
+        # about (interrupted downloads, legacy title-named files)
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute("SELECT key, filename FROM tracks").fetchall()
+            known = set()
+            for key, filename in rows:
+                if os.path.isfile(self._path(filename)):
+                    known.add(filename)
+                else:
+                    self._conn.execute("DELETE FROM tracks WHERE key = ?", (key,))
+            self._conn.commit()
+            for filename in os.listdir(self.directory):
+                if filename in known or filename.startswith(INDEX_NAME):
+                    continue
+                try:
+                    if now - os.path.getmtime(self._path(filename)) < STRAY_FILE_AGE:
+                        continue
+                    os.remove(self._path(filename))
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logging.error(f"Failed to remove stray cache file {filename}: {str(e)}")
+            total = self._indexed_size()
+        logging.info(f"Audio cache ready: {len(known)} tracks, {total} bytes")
+        return total
+
+    def contains(self, key):
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM tracks WHERE key = ?", (key,)).fetchone() is not None
+
+    def lookup(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT filename, size FROM tracks WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            filename, size = row
+            path = self._path(filename)
+            if not os.path.isfile(path):
+                self._conn.execute("DELETE FROM tracks WHERE key = ?", (key,))
+                self._conn.commit()
+                self.total_size -= size
+                return None
+            # Playback looks tracks up on the event loop, so the access is only
+            # noted here and written with the next flush_access() or commit()
+            access = self._accessed.setdefault(key, [0.0, 0])
+            access[0] = time.time()
+            access[1] += 1
+            return path
+
+    def flush_access(self):
+        with self._lock:
+            if self._write_access():
+                self._conn.commit()
+
+    def _write_access(self):
+        if not self._accessed:
+            return False
+        rows = [(last_access, hits, key) for key, (last_access, hits) in self._accessed.items()]
+        self._accessed = {}
+        self._conn.executemany("UPDATE tracks SET last_access = ?, hits = hits + ? WHERE key = ?", rows)
+        return True
+
+    def temp_path(self, key):
+        return self._path(f"{self._basename(key)}.{os.getpid()}{TEMP_SUFFIX}")
+
+    def _indexed_size(self):
+        return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM tracks").fetchone()[0]
+
+    def commit(self, key, temp_path, ext):
+        # Atomic rename, so a half-written file is never visible under its final name
+        filename = f"{self._basename(key)}.{ext}"
+        path = self._path(filename)
+        os.replace(temp_path, path)
+        size = os.path.getsize(path)
+        with self._lock:
+            # Eviction order depends on the access times
+            self._write_access()
+            row = self._conn.execute("SELECT filename, size FROM tracks WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.total_size -= row[1]
+                if row[0] != filename:
+                    self._remove_file(row[0])
+            self._conn.execute("INSERT OR REPLACE INTO tracks (key, filename, size, last_access, hits) VALUES (?, ?, ?, ?, 0)",
+                               (key, filename, size, time.time()))
+            # Other processes sharing the directory add to it too
+            self.total_size = self._indexed_size()
+            if self.total_size > self.max_size:
+                self._evict(keep=key)
+            self._conn.commit()
+        return path
+
+    def discard(self, temp_path):
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+
+    def _remove_file(self, filename):
+        try:
+            os.remove(self._path(filename))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            # Usually a file still open for playback on Windows; it is dropped on the next start
+            logging.error(f"Failed to evict cache file {filename}: {str(e)}")
+
+    def _evict(self, keep):
+        # Least recently used first, down to the low-water mark
+        cursor = self._conn.execute("SELECT key, filename, size FROM tracks ORDER BY last_access")
+        victims = []
+        for key, filename, size in cursor:
+            if self.total_size <= self.low_water:
+                break
+            if key == keep:
+                continue
+            victims.append((key, filename))
+            self.total_size -= size
+        for key, filename in victims:
+            self._conn.execute("DELETE FROM tracks WHERE key = ?", (key,))
+            self._remove_file(filename)
+        if victims:
+            logging.info(f"Evicted {len(victims)} cached tracks, cache now {self.total_size} bytes")
+
+    def stats(self):
+        with self._lock:
+            count, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM tracks").fetchone()
+        return {"tracks": count, "bytes": size}
+
+
+class TTLCache:
+    # In-memory LRU whose entries expire individually. With a path, entries are
+    # also written to SQLite so warm metadata survives restarts. Values must be
+    # JSON serializable. Writes are batched onto one writer thread with its own
+    # connection, which also deletes expired rows every METADATA_PRUNE_INTERVAL.
+    def __init__(self, maxsize, default_ttl, path=None, namespace="default"):
+        self.maxsize = maxsize
+        self.default_ttl = default_ttl
+        self.namespace = namespace
+        self.path = path
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._writer = None
+        self._executor = None
+        self._pending = {}  # key -> (expires, JSON) waiting for the writer thread
+        self._flush_scheduled = False
+        self._next_prune = 0
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS metadata
+                                  (namespace TEXT NOT NULL, key TEXT NOT NULL, expires REAL NOT NULL,
+                                   value TEXT NOT NULL, PRIMARY KEY (namespace, key))''')
+            self._conn.execute("DELETE FROM metadata WHERE expires <= ?", (time.time(),))
+            self._conn.commit()
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"metadata-{namespace}")
+            self._next_prune = time.time() + METADATA_PRUNE_INTERVAL
+
+    def _remember(self, key, expires, value):
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                if item[0] > now:
+                    self._data.move_to_end(key)
+                    return item[1]
+                del self._data[key]
+            if self._conn is None:
+                return None
+            pending = self._pending.get(key)
+            if pending is not None:
+                # Fell out of memory before the writer got to it
+                if pending[0] <= now:
+                    return None
+                value = json.loads(pending[1])
+                self._remember(key, pending[0], value)
+                return value
+            row = self._conn.execute("SELECT expires, value FROM metadata WHERE namespace = ? AND key = ?",
+                                     (self.namespace, key)).fetchone()
+            if row is None or row[0] <= now:
+                return None
+            value = json.loads(row[1])
+            self._remember(key, row[0], value)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.default_ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        expires = time.time() + ttl
+        with self._lock:
+            self._remember(key, expires, value)
+            if self._executor is None:
+                return
+            self._pending[key] = (expires, json.dumps(value))
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        self._executor.submit(self._write)
+
+    def flush(self):
+        # Blocks until everything set so far is on disk
+        if self._executor is not None:
+            self._executor.submit(self._write).result()
+
+    def _write(self):
+        with self._lock:
+            rows = [(self.namespace, key, expires, value) for key, (expires, value) in self._pending.items()]
+            self._pending = {}
+            self._flush_scheduled = False
+        try:
+            if self._writer is None:
+                self._writer = sqlite3.connect(self.path)
+                self._writer.execute("PRAGMA synchronous=NORMAL")
+            with self._writer:
+                if rows:
+                    self._writer.executemany("INSERT OR REPLACE INTO metadata (namespace, key, expires, value) VALUES (?, ?, ?, ?)",
+                                             rows)
+                now = time.time()
+                if now >= self._next_prune:
+                    self._writer.execute("DELETE FROM metadata WHERE namespace = ? AND expires <= ?", (self.namespace, now))
+                    self._next_prune = now + METADATA_PRUNE_INTERVAL
+        except sqlite3.Error as e:
+            logging.error(f"Failed to write {self.namespace} metadata: {str(e)}")
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,179 @@
+import os
+import json
+import asyncio
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+JOURNAL_SUFFIX = ".jsonl"
+
+# Journal operations, one JSON array per line:
+#   ["extend", [track, ...]]   tracks appended to the queue
+#   ["advance"]                the queue head becomes the current track, at position 0
+#   ["previous", track|null]   the previous track
+#   ["idle"]                   nothing is playing
+#   ["remove", index]          queue entry removed
+#   ["move", from, to]         queue entry moved
+#   ["jump", count]            first count entries skipped; with loop on they go to the back
+#   ["loop", bool]
+#   ["position", seconds]      playback position checkpoint of the current track
+#   ["channels", voice_id, text_id]
+#   ["snapshot", state]        full state; compaction rewrites the file as one snapshot.
+#                              A hibernated player's snapshot keeps resolved stream URLs.
+
+
+def empty_state():
+    return {"queue": [], "current": None, "previous": None, "loop": False, "position": 0,
+            "voice_channel": None, "text_channel": None, "hibernated": False}
+
+
+def replay(ops):
+    state = empty_state()
+    for op in ops:
+        kind = op[0]
+        if kind == "snapshot":
+            state = dict(empty_state(), **op[1])
+        elif kind == "extend":
+            state["queue"].extend(op[1])
+        elif kind == "advance":
+            state["current"] = state["queue"].pop(0) if state["queue"] else None
+            state["position"] = 0
+        elif kind == "previous":
+            state["previous"] = op[1]
+        elif kind == "idle":
+            state["current"] = None
+            state["position"] = 0
+        elif kind == "remove":
+            del state["queue"][op[1]]
+        elif kind == "move":
+            state["queue"].insert(op[2], state["queue"].pop(op[1]))
+        elif kind == "jump":
+            skipped, state["queue"] = state["queue"][:op[1]], state["queue"][op[1]:]
+            if state["loop"]:
+                state["queue"].extend(skipped)
+        elif kind == "loop":
+            state["loop"] = op[1]
+        elif kind == "position":
+            state["position"] = op[1]
+        elif kind == "channels":
+            state["voice_channel"], state["text_channel"] = op[1], op[2]
+    return state
+
+
+class QueueJournal:
+    # Append-only per-guild journal of queue changes. Writes are buffered on
+    # the event loop and appended in order by one worker thread; once a file
+    # holds more than compact_after operations the owner is asked for a
+    # snapshot and the file is rewritten as that single line.
+    def __init__(self, directory, compact_after=500, flush_delay=0.5):
+        self.directory = directory
+        self.compact_after = compact_after
+        self.flush_delay = flush_delay
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="queue-journal")
+        self._pending = []
+        self._flush_task = None
+        self._counts = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, guild_id):
+        return os.path.join(self.directory, f"{guild_id}{JOURNAL_SUFFIX}")
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+
+    def guild_ids(self):
+        return [int(name[:-len(JOURNAL_SUFFIX)]) for name in os.listdir(self.directory)
+                if name.endswith(JOURNAL_SUFFIX) and name[:-len(JOURNAL_SUFFIX)].isdigit()]
+
+    def append(self, guild_id, *op):
+        self._counts[guild_id] = self._counts.get(guild_id, 0) + 1
+        self._queue(("append", guild_id, json.dumps(op, separators=(",", ":"))))
+
+    def needs_compaction(self, guild_id):
+        return self._counts.get(guild_id, 0) > self.compact_after
+
+    def compact(self, guild_id, state):
+        self._counts[guild_id] = 1
+        self._queue(("compact", guild_id, json.dumps(["snapshot", state], separators=(",", ":"))))
+
+    def discard(self, guild_id):
+        self._counts.pop(guild_id, None)
+        self._queue(("discard", guild_id, None))
+
+    def _queue(self, entry):
+        self._pending.append(entry)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_delay)
+        await self.flush()
+
+    async def flush(self):
+        batch, self._pending = self._pending, []
+        if batch:
+            await self._run(self._write, batch)
+
+    def _write(self, batch):
+        # Consecutive appends to one guild go out as one write
+        lines = {}
+        order = []
+        for action, guild_id, line in batch:
+            if action == "append":
+                if guild_id not in lines:
+                    lines[guild_id] = []
+                    order.append(guild_id)
+                lines[guild_id].append(line)
+                continue
+            self._append_lines(lines, order)
+            lines, order = {}, []
+            try:
+                if action == "compact":
+                    self._rewrite(guild_id, line)
+                else:
+                    os.remove(self._path(guild_id))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.error(f"Failed to {action} queue journal for guild {guild_id}: {str(e)}")
+        self._append_lines(lines, order)
+
+    def _append_lines(self, lines, order):
+        for guild_id in order:
+            try:
+                with open(self._path(guild_id), "a", encoding="utf-8") as f:
+                    f.write("\n".join(lines[guild_id]) + "\n")
+            except OSError as e:
+                logging.error(f"Failed to append to queue journal for guild {guild_id}: {str(e)}")
+
+    def _rewrite(self, guild_id, line):
+        path = self._path(guild_id)
+        temp = path + ".tmp"
+        with open(temp, "w", encoding="utf-8") as f:
+            f.write(line + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, path)
+
+    def _read(self, guild_id):
+        ops = []
+        try:
+            with open(self._path(guild_id), encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        ops.append(json.loads(line))
+                    except ValueError:
+                        # A torn last line from a crash mid-write
+                        logging.error(f"Ignoring corrupt queue journal line for guild {guild_id}")
+        except FileNotFoundError:
+            return None
+        return ops
+
+    async def load(self, guild_id):
+        # Returns the replayed state, or None without a journal
+        ops = await self._run(self._read, guild_id)
+        if ops is None:
+            return None
+        self._counts[guild_id] = len(ops)
+        return replay(ops)
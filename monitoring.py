@@ -0,0 +1,307 @@
+import os
+import sys
+import time
+import bisect
+import asyncio
+import logging
+import threading
+import functools
+import traceback
+import contextlib
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def resident_memory():
+    # Resident set size of this process in bytes, or None where it cannot be read
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Only the peak is available here; ru_maxrss is in bytes on macOS and KiB elsewhere
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def format_bytes(size):
+    if size is None:
+        return "n/a"
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.2f} GiB"
+
+
+# Latency buckets in seconds, shared by every histogram
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SLOW_HANDLER = 5.0  # Seconds after which a handler's run is logged
+
+
+class Histogram:
+    __slots__ = ("count", "total", "max", "counts")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def snapshot(self):
+        return {"count": self.count, "mean": self.total / self.count if self.count else 0.0,
+                "p50": self.quantile(0.5), "p99": self.quantile(0.99), "max": self.max}
+
+
+class Stats:
+    # In-process counters and latency histograms, keyed by name plus labels.
+    # Updated from the event loop and from worker threads alike.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def add_gauge(self, name, amount, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.gauges[key] = self.gauges.get(key, 0) + amount
+
+    def set_gauges(self, name, values):
+        # Replaces every series of a gauge; `values` maps label dicts, as
+        # tuples of pairs, to values, so series that went away are dropped
+        with self._lock:
+            for key in [key for key in self.gauges if key[0] == name]:
+                del self.gauges[key]
+            for labels, value in values.items():
+                self.gauges[(name, tuple(sorted(labels)))] = value
+
+    def set_gauge(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "counters": {key: value for key, value in self.counters.items()},
+                "gauges": {key: value for key, value in self.gauges.items()},
+                "histograms": {key: histogram.snapshot() for key, histogram in self.histograms.items()},
+            }
+
+
+stats = Stats()
+
+
+@contextlib.contextmanager
+def timing(handler):
+    # Times a block into the handler_seconds histogram and logs it when slow
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stats.observe("handler_seconds", elapsed, handler=handler)
+        if elapsed > SLOW_HANDLER:
+            logging.warning(f"Handler {handler} took {elapsed:.2f}s")
+
+
+def timed(handler):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with timing(handler):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class LoopMonitor:
+    # A coroutine wakes every `interval` and records how late it woke (loop
+    # lag). A watchdog thread notices when that coroutine has not run for
+    # `stall_after` seconds and logs the loop thread's stack right then, which
+    # is the synchronous code holding the loop.
+    def __init__(self, interval=0.5, stall_after=1.0):
+        self.interval = interval
+        self.stall_after = stall_after
+        self.last_lag = 0.0
+        self._heartbeat = None
+        self._loop_thread = None
+        self._task = None
+
+    def start(self):
+        # Call from the event loop thread
+        if self._task is not None:
+            return
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._sample())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    async def _sample(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._heartbeat = now
+            self.last_lag = max(now - start - self.interval, 0.0)
+            stats.observe("loop_lag_seconds", self.last_lag)
+            if self.last_lag > self.stall_after:
+                logging.warning(f"Event loop lagged {self.last_lag:.2f}s")
+
+    def _watch(self):
+        reported = None
+        while True:
+            time.sleep(self.interval / 2)
+            beat = self._heartbeat
+            stalled = time.monotonic() - beat - self.interval
+            if stalled < self.stall_after or beat == reported:
+                continue
+            reported = beat
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "unavailable\n"
+            stats.inc("loop_stalls_total")
+            logging.warning(f"Event loop blocked for {stalled:.2f}s, loop thread is at:\n{stack.rstrip()}")
+
+
+class RateLimitLogHandler(logging.Handler):
+    # discord.py only reports 429s through its logger; count them and the
+    # time it is told to back off for
+    def emit(self, record):
+        if not isinstance(record.msg, str):
+            return
+        if record.msg.startswith("We are being rate limited.") and record.args:
+            stats.inc("rest_ratelimited_total", scope="route")
+            stats.observe("rest_ratelimit_wait_seconds", float(record.args[-1]))
+        elif record.msg.startswith("Global rate limit has been hit."):
+            stats.inc("rest_ratelimited_total", scope="global")
+
+
+def instrument_http(http):
+    # Times every REST call, including the time spent queued on a rate limit
+    # bucket, per method and route template
+    request = http.request
+
+    @functools.wraps(request)
+    async def timed_request(route, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await request(route, **kwargs)
+        finally:
+            stats.observe("rest_request_seconds", time.perf_counter() - start, method=route.method, route=route.path)
+
+    http.request = timed_request
+    logging.getLogger("discord.http").addHandler(RateLimitLogHandler())
+
+
+# Prometheus text exposition
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+
+def render_prometheus(prefix):
+    with stats._lock:
+        counters = sorted(stats.counters.items())
+        gauges = sorted(stats.gauges.items())
+        histograms = sorted((key, histogram.count, histogram.total, list(histogram.counts))
+                            for key, histogram in stats.histograms.items())
+    lines = []
+    typed = set()
+
+    def declare(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in counters:
+        declare(prefix + name, "counter")
+        lines.append(f"{prefix}{name}{_labels(labels)} {value}")
+    for (name, labels), value in gauges:
+        declare(prefix + name, "gauge")
+        lines.append(f"{prefix}{name}{_labels(labels)} {value}")
+    for (name, labels), count, total, counts in histograms:
+        declare(prefix + name, "histogram")
+        cumulative = 0
+        for bound, bucket in zip(LATENCY_BUCKETS, counts):
+            cumulative += bucket
+            lines.append(f"{prefix}{name}_bucket{_labels(labels, [('le', bound)])} {cumulative}")
+        lines.append(f"{prefix}{name}_bucket{_labels(labels, [('le', '+Inf')])} {count}")
+        lines.append(f"{prefix}{name}_sum{_labels(labels)} {total}")
+        lines.append(f"{prefix}{name}_count{_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+async def _serve_metrics(reader, writer, prefix, collect):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while await asyncio.wait_for(reader.readline(), 5) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[1].split(b"?")[0] == b"/metrics":
+            collect()
+            status, body = "200 OK", render_prometheus(prefix).encode("utf-8")
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("ascii") + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host, port, prefix, collect):
+    # `collect` runs before each scrape to refresh gauges that are cheaper to
+    # read on demand than to keep up to date
+    server = await asyncio.start_server(functools.partial(_serve_metrics, prefix=prefix, collect=collect), host, port)
+    logging.info(f"Metrics available at http://{host}:{port}/metrics")
+    return server
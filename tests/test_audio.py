@@ -0,0 +1,66 @@
+import pytest
+from audio import FRAME_MS, PackedOpusAudio, write_packed_opus
+
+
+def packets(count):
+    return [bytes([0xFC, idx % 256]) * (1 + idx % 7) for idx in range(count)]
+
+
+def read_all(source):
+    frames = []
+    while True:
+        frame = source.read()
+        if not frame:
+            return frames
+        frames.append(frame)
+
+
+def test_packed_round_trip(tmp_path):
+    path = str(tmp_path / "track.opf")
+    original = packets(250)
+    write_packed_opus(original, path)
+    source = PackedOpusAudio(path)
+    try:
+        assert source.frame_count == 250
+        assert source.duration == 250 * FRAME_MS / 1000
+        assert source.is_opus()
+        assert read_all(source) == original
+    finally:
+        source.cleanup()
+
+
+def test_packed_start_and_seek(tmp_path):
+    path = str(tmp_path / "track.opf")
+    original = packets(250)
+    write_packed_opus(original, path)
+    # 2 s in is frame 100 at 20 ms per frame
+    source = PackedOpusAudio(path, start=2)
+    try:
+        assert source.elapsed == 2
+        assert source.read() == original[100]
+        source.seek(4.5)
+        assert source.read() == original[225]
+        source.seek(60)
+        assert source.read() == b""
+        source.seek(-1)
+        assert source.read() == original[0]
+    finally:
+        source.cleanup()
+
+
+def test_packed_empty_track(tmp_path):
+    path = str(tmp_path / "empty.opf")
+    write_packed_opus([], path)
+    source = PackedOpusAudio(path)
+    try:
+        assert source.frame_count == 0
+        assert source.read() == b""
+    finally:
+        source.cleanup()
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / "track.opus"
+    path.write_bytes(b"OggS" + b"\0" * 64)
+    with pytest.raises(ValueError):
+        PackedOpusAudio(str(path))
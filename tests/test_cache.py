@@ -0,0 +1,81 @@
+import os
+import time
+from cache import AudioCache
+
+
+def add_track(cache, key, size):
+    temp_path = cache.temp_path(key)
+    with open(temp_path, "wb") as f:
+        f.write(b"\0" * size)
+    return cache.commit(key, temp_path, "opf")
+
+
+def test_commit_and_lookup(tmp_path):
+    cache = AudioCache(str(tmp_path), max_size=1000)
+    path = add_track(cache, "youtube:a", 100)
+    assert os.path.isfile(path)
+    assert cache.contains("youtube:a")
+    assert cache.lookup("youtube:a") == path
+    assert cache.lookup("youtube:b") is None
+    assert cache.stats() == {"tracks": 1, "bytes": 100}
+
+
+def test_eviction_drops_least_recently_used_down_to_low_water(tmp_path):
+    cache = AudioCache(str(tmp_path), max_size=300, low_water=200)
+    for key in ("youtube:a", "youtube:b", "youtube:c"):
+        add_track(cache, key, 100)
+        time.sleep(0.01)
+    # A hit makes "a" the most recently used, even before the access is flushed
+    cache.lookup("youtube:a")
+    add_track(cache, "youtube:d", 100)
+    assert not cache.contains("youtube:b")
+    assert not cache.contains("youtube:c")
+    assert cache.contains("youtube:a")
+    assert cache.contains("youtube:d")
+    assert cache.total_size == 200
+
+
+def test_lookup_defers_access_write(tmp_path):
+    cache = AudioCache(str(tmp_path), max_size=1000)
+    add_track(cache, "youtube:a", 10)
+    cache.lookup("youtube:a")
+    cache.lookup("youtube:a")
+    hits = lambda: cache._conn.execute("SELECT hits FROM tracks WHERE key = 'youtube:a'").fetchone()[0]
+    assert hits() == 0
+    cache.flush_access()
+    assert hits() == 2
+
+
+def test_reconcile_drops_missing_and_stray_files(tmp_path):
+    cache = AudioCache(str(tmp_path), max_size=1000)
+    path = add_track(cache, "youtube:a", 10)
+    add_track(cache, "youtube:b", 10)
+    os.remove(path)
+    stray = tmp_path / "leftover.part"
+    stray.write_bytes(b"x")
+    old = time.time() - 2 * 3600
+    os.utime(stray, (old, old))
+    # Possibly another process's download in flight
+    fresh = tmp_path / "downloading.part"
+    fresh.write_bytes(b"x")
+    cache._conn.close()
+    reopened = AudioCache(str(tmp_path), max_size=1000)
+    assert not reopened.contains("youtube:a")
+    assert reopened.contains("youtube:b")
+    assert reopened.total_size == 10
+    assert not stray.exists()
+    assert fresh.exists()
+
+
+def test_processes_sharing_a_directory_share_the_size_limit(tmp_path):
+    first = AudioCache(str(tmp_path), max_size=250, low_water=200)
+    second = AudioCache(str(tmp_path), max_size=250, low_water=200)
+    assert str(os.getpid()) in os.path.basename(first.temp_path("youtube:a"))
+    add_track(first, "youtube:a", 100)
+    time.sleep(0.01)
+    add_track(second, "youtube:b", 100)
+    time.sleep(0.01)
+    add_track(first, "youtube:c", 100)
+    assert not first.contains("youtube:a")
+    assert first.stats() == {"tracks": 2, "bytes": 200}
+    assert second.stats() == first.stats()
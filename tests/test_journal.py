@@ -0,0 +1,82 @@
+import asyncio
+from journal import QueueJournal, empty_state, replay
+
+
+def track(title):
+    return {"title": title, "webpage_url": f"https://example.com/{title}"}
+
+
+def titles(tracks):
+    return [entry["title"] for entry in tracks]
+
+
+def test_empty_journal_replays_to_empty_state():
+    assert replay([]) == empty_state()
+
+
+def test_queue_operations_replay_in_order():
+    state = replay([
+        ["extend", [track("a"), track("b"), track("c"), track("d")]],
+        ["advance"],
+        ["position", 42.5],
+        ["remove", 1],
+        ["move", 1, 0],
+        ["previous", track("z")],
+        ["channels", 10, 20],
+    ])
+    assert state["current"]["title"] == "a"
+    assert titles(state["queue"]) == ["d", "b"]
+    assert state["previous"]["title"] == "z"
+    assert state["position"] == 42.5
+    assert (state["voice_channel"], state["text_channel"]) == (10, 20)
+
+
+def test_advance_resets_position_and_idle_clears_current():
+    state = replay([["extend", [track("a")]], ["advance"], ["position", 30], ["advance"]])
+    assert state["current"] is None
+    assert state["position"] == 0
+    state = replay([["extend", [track("a")]], ["advance"], ["position", 30], ["idle"]])
+    assert state["current"] is None
+    assert state["position"] == 0
+
+
+def test_jump_rotates_skipped_tracks_only_with_loop():
+    ops = [["extend", [track("a"), track("b"), track("c")]], ["jump", 2]]
+    assert titles(replay(ops)["queue"]) == ["c"]
+    assert titles(replay([["loop", True]] + ops)["queue"]) == ["c", "a", "b"]
+
+
+def test_snapshot_replaces_earlier_state():
+    snapshot = {"queue": [track("x")], "current": track("y"), "loop": True, "position": 12}
+    state = replay([["extend", [track("a")]], ["channels", 1, 2], ["snapshot", snapshot], ["advance"]])
+    assert state["current"]["title"] == "x"
+    assert state["queue"] == []
+    assert state["loop"] is True
+    assert state["voice_channel"] is None
+    assert state["hibernated"] is False
+
+
+def test_journal_round_trip_with_compaction_and_torn_line(tmp_path):
+    async def scenario():
+        journal = QueueJournal(str(tmp_path), compact_after=2, flush_delay=0)
+        journal.append(1, "extend", [track("a"), track("b")])
+        journal.append(1, "advance")
+        journal.append(1, "position", 5)
+        assert journal.needs_compaction(1)
+        journal.compact(1, replay([["extend", [track("a"), track("b")]], ["advance"], ["position", 5]]))
+        journal.append(1, "loop", True)
+        journal.append(2, "extend", [track("c")])
+        await journal.flush()
+        with open(tmp_path / "1.jsonl", "a", encoding="utf-8") as f:
+            f.write('["advance"')
+        return journal
+
+    journal = asyncio.run(scenario())
+    assert len((tmp_path / "1.jsonl").read_text(encoding="utf-8").splitlines()) == 3
+    assert sorted(journal.guild_ids()) == [1, 2]
+    state = asyncio.run(QueueJournal(str(tmp_path)).load(1))
+    assert state["current"]["title"] == "a"
+    assert titles(state["queue"]) == ["b"]
+    assert state["position"] == 5
+    assert state["loop"] is True
+    assert asyncio.run(QueueJournal(str(tmp_path)).load(3)) is None
@@ -0,0 +1,29 @@
+import importlib
+import pytest
+
+
+@pytest.fixture(scope="module")
+def parse_timestamp(tmp_path_factory):
+    # Importing the bot creates its databases and log in the working directory
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(tmp_path_factory.mktemp("bot"))
+        bot2 = importlib.import_module("bot2")
+    return bot2.parse_timestamp
+
+
+@pytest.mark.parametrize("text, seconds", [
+    ("90", 90),
+    (" 1:30 ", 90),
+    ("1:02:30", 3750),
+    ("0:05.5", 5.5),
+    ("0", 0),
+])
+def test_valid_timestamps(parse_timestamp, text, seconds):
+    assert parse_timestamp(text) == seconds
+
+
+@pytest.mark.parametrize("text", [
+    "", "abc", "1:60", "1:75:00", "-5", "1:-1", "1.5:30", "1:2:3:4", "nan", "inf", "1:nan", "-inf",
+])
+def test_invalid_timestamps(parse_timestamp, text):
+    assert parse_timestamp(text) is None
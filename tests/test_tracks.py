@@ -0,0 +1,90 @@
+import random
+import pytest
+from tracks import Track, TrackQueue
+
+
+def make_tracks(count):
+    return [Track(f"t{idx}", f"https://example.com/{idx}") for idx in range(count)]
+
+
+def titles(queue):
+    return [track.title for track in queue]
+
+
+def test_queue_matches_list_under_random_operations():
+    rng = random.Random(7)
+    expected = make_tracks(50)
+    queue = TrackQueue(expected)
+    extra = iter(make_tracks(3000)[50:])
+    for _ in range(2000):
+        op = rng.randrange(6)
+        if op == 0:
+            track = next(extra)
+            idx = rng.randint(0, len(expected))
+            queue.insert(idx, track)
+            expected.insert(idx, track)
+        elif op == 1 and expected:
+            idx = rng.randrange(len(expected))
+            assert queue.pop(idx) is expected.pop(idx)
+        elif op == 2 and expected:
+            src, dst = rng.randrange(len(expected)), rng.randrange(len(expected))
+            queue.move(src, dst)
+            expected.insert(dst, expected.pop(src))
+        elif op == 3:
+            track = next(extra)
+            queue.appendleft(track)
+            expected.insert(0, track)
+        elif op == 4 and expected:
+            assert queue.popleft() is expected.pop(0)
+        elif op == 5:
+            track = next(extra)
+            queue.append(track)
+            expected.append(track)
+        assert len(queue) == len(expected)
+    assert list(queue) == expected
+    assert [queue[idx] for idx in range(len(expected))] == expected
+    if expected:
+        assert queue[-1] is expected[-1]
+
+
+def test_take_front_and_extend_queue():
+    queue = TrackQueue(make_tracks(10))
+    front = queue.take_front(3)
+    assert titles(front) == ["t0", "t1", "t2"]
+    assert titles(queue) == [f"t{idx}" for idx in range(3, 10)]
+    queue.extend_queue(front)
+    assert not front
+    assert titles(queue)[-3:] == ["t0", "t1", "t2"]
+    assert len(queue.take_front(100)) == 10
+    assert not queue
+
+
+def test_index_errors_and_shuffle_keeps_entries():
+    queue = TrackQueue(make_tracks(5))
+    with pytest.raises(IndexError):
+        queue[5]
+    with pytest.raises(IndexError):
+        TrackQueue().popleft()
+    queue.shuffle()
+    assert sorted(titles(queue)) == [f"t{idx}" for idx in range(5)]
+
+
+def test_record_round_trip():
+    track = Track("a", "https://example.com/a", duration=61, id="a", extractor="Youtube",
+                  stream_url="https://media.example.com/a?expire=2000000000", expires=2000000000)
+    assert "stream_url" not in track.to_record()
+    restored = Track.from_record(track.to_record(with_stream=True))
+    assert (restored.title, restored.duration, restored.stream_url, restored.expires) == \
+        ("a", 61, track.stream_url, 2000000000)
+
+
+def test_from_record_accepts_legacy_dicts():
+    resolved = Track.from_record({"title": "a", "url": "https://media.example.com/a?expire=2000000000",
+                                  "webpage_url": "https://example.com/a", "thumbnail": "", "duration": 5,
+                                  "expires": 2000000000, "id": "a", "extractor": "Youtube", "acodec": "opus"})
+    assert resolved.webpage_url == "https://example.com/a"
+    assert resolved.stream_url == "https://media.example.com/a?expire=2000000000"
+    assert resolved.expires == 2000000000
+    favorite = Track.from_record({"title": "b", "url": "https://example.com/b", "unknown": 1})
+    assert favorite.webpage_url == "https://example.com/b"
+    assert favorite.stream_url is None
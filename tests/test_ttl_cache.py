@@ -0,0 +1,68 @@
+import time
+import cache
+from cache import TTLCache
+
+
+def test_entries_expire_individually(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "time", lambda: now[0])
+    store = TTLCache(maxsize=10, default_ttl=60)
+    store.set("short", 1, ttl=5)
+    store.set("long", 2)
+    now[0] += 10
+    assert store.get("short") is None
+    assert store.get("long") == 2
+    now[0] += 60
+    assert store.get("long") is None
+
+
+def test_non_positive_ttl_is_not_stored():
+    store = TTLCache(maxsize=10, default_ttl=0)
+    store.set("key", "value")
+    store.set("other", "value", ttl=-5)
+    assert store.get("key") is None
+    assert store.get("other") is None
+
+
+def test_least_recently_used_entry_is_dropped():
+    store = TTLCache(maxsize=2, default_ttl=60)
+    store.set("a", 1)
+    store.set("b", 2)
+    assert store.get("a") == 1
+    store.set("c", 3)
+    assert store.get("b") is None
+    assert store.get("a") == 1
+    assert store.get("c") == 3
+
+
+def test_entries_survive_a_restart(tmp_path):
+    path = str(tmp_path / "metadata.db")
+    store = TTLCache(maxsize=10, default_ttl=60, path=path, namespace="search")
+    store.set("query", [{"title": "song"}])
+    store.flush()
+    reopened = TTLCache(maxsize=10, default_ttl=60, path=path, namespace="search")
+    assert reopened.get("query") == [{"title": "song"}]
+    # Namespaces share the file but not their keys
+    other = TTLCache(maxsize=10, default_ttl=60, path=path, namespace="stream")
+    assert other.get("query") is None
+
+
+def test_unwritten_entry_is_found_after_leaving_memory(tmp_path):
+    store = TTLCache(maxsize=1, default_ttl=60, path=str(tmp_path / "metadata.db"))
+    store._flush_scheduled = True  # Keep the writer from running
+    store.set("a", 1)
+    store.set("b", 2)
+    assert store.get("a") == 1
+
+
+def test_expired_rows_are_pruned(tmp_path, monkeypatch):
+    path = str(tmp_path / "metadata.db")
+    store = TTLCache(maxsize=10, default_ttl=60, path=path)
+    store.set("old", 1, ttl=1)
+    store.flush()
+    now = time.time() + cache.METADATA_PRUNE_INTERVAL + 5
+    monkeypatch.setattr(cache.time, "time", lambda: now)
+    store.set("new", 2)
+    store.flush()
+    keys = [row[0] for row in store._conn.execute("SELECT key FROM metadata")]
+    assert keys == ["new"]
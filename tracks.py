@@ -0,0 +1,264 @@
+import sys
+import random
+from urllib.parse import urlparse, parse_qs
+
+RECORD_FIELDS = ("title", "webpage_url", "thumbnail", "duration", "id", "extractor", "acodec")
+
+
+def stream_url_expiry(url):
+    # googlevideo URLs carry their expiry as a unix timestamp in the `expire` query parameter
+    try:
+        return int(parse_qs(urlparse(url).query)["expire"][0])
+    except (KeyError, IndexError, ValueError):
+        return None
+
+
+def _intern(value):
+    return sys.intern(value) if value else None
+
+
+class Track:
+    # One queue entry. Slots instead of a dict per entry, the handful of
+    # extractor and codec names shared through interning, and the stream URL
+    # left empty until the track is resolved near the head of the queue.
+    __slots__ = ("title", "webpage_url", "thumbnail", "duration", "id", "extractor", "acodec",
+                 "stream_url", "expires")
+
+    def __init__(self, title, webpage_url, thumbnail="", duration=0, id=None, extractor=None, acodec=None,
+                 stream_url=None, expires=None):
+        self.title = title
+        self.webpage_url = webpage_url
+        self.thumbnail = thumbnail or ""
+        self.duration = duration or 0
+        self.id = id
+        self.extractor = _intern(extractor)
+        self.acodec = _intern(acodec)
+        self.stream_url = stream_url
+        self.expires = expires
+
+    @property
+    def url(self):
+        # What FFmpeg should open: the stream once resolved, the page before
+        return self.stream_url or self.webpage_url
+
+    @classmethod
+    def from_entry(cls, entry):
+        # Flat playlist entries carry only the page URL; fully extracted ones
+        # also carry the stream URL of the selected format
+        url = entry.get("url") or entry.get("webpage_url")
+        webpage_url = entry.get("webpage_url") or url
+        thumbnail = entry.get("thumbnail") or (entry.get("thumbnails") or [{}])[-1].get("url", "")
+        stream_url = url if url != webpage_url else None
+        return cls(entry.get("title") or url, webpage_url, thumbnail, entry.get("duration"), entry.get("id"),
+                   entry.get("extractor_key") or entry.get("ie_key"), entry.get("acodec"),
+                   stream_url, stream_url_expiry(stream_url) if stream_url else None)
+
+    @classmethod
+    def from_record(cls, record):
+        # Records cached or journaled before Track existed carry "url": the
+        # stream once resolved, the page before. Keys Track does not know are ignored.
+        fields = {key: record[key] for key in RECORD_FIELDS + ("stream_url", "expires") if key in record}
+        url = record.get("url")
+        fields.setdefault("webpage_url", url)
+        fields.setdefault("title", fields["webpage_url"])
+        if url and url != fields["webpage_url"] and "stream_url" not in fields:
+            fields["stream_url"] = url
+            fields.setdefault("expires", stream_url_expiry(url))
+        return cls(**fields)
+
+    def to_record(self, with_stream=False):
+        # JSON-friendly form; stream URLs expire, so they are left out unless asked for
+        record = {field: getattr(self, field) for field in RECORD_FIELDS if getattr(self, field) is not None}
+        if with_stream and self.stream_url:
+            record["stream_url"] = self.stream_url
+            record["expires"] = self.expires
+        return record
+
+    def apply_stream_info(self, info):
+        # Fills in what resolving the track with yt-dlp found out
+        self.stream_url = info["url"]
+        self.expires = stream_url_expiry(info["url"])
+        self.id = info.get("id") or self.id
+        self.extractor = _intern(info.get("extractor_key")) or self.extractor
+        self.acodec = _intern(info.get("acodec"))
+        self.duration = info.get("duration") or self.duration
+        self.webpage_url = info.get("webpage_url") or self.webpage_url
+
+    def copy(self):
+        return Track(self.title, self.webpage_url, self.thumbnail, self.duration, self.id, self.extractor,
+                     self.acodec, self.stream_url, self.expires)
+
+
+def track_record(track, with_stream=False):
+    return track.to_record(with_stream) if track is not None else None
+
+
+class _Node:
+    __slots__ = ("track", "priority", "size", "left", "right")
+
+    def __init__(self, track, priority):
+        self.track = track
+        self.priority = priority
+        self.size = 1
+        self.left = None
+        self.right = None
+
+
+def _size(node):
+    return node.size if node is not None else 0
+
+
+def _update(node):
+    node.size = 1 + _size(node.left) + _size(node.right)
+
+
+def _split(node, count):
+    # Splits off the first `count` entries: (first count, rest)
+    if node is None:
+        return None, None
+    if _size(node.left) >= count:
+        head, node.left = _split(node.left, count)
+        _update(node)
+        return head, node
+    node.right, tail = _split(node.right, count - _size(node.left) - 1)
+    _update(node)
+    return node, tail
+
+
+def _merge(head, tail):
+    if head is None:
+        return tail
+    if tail is None:
+        return head
+    if head.priority > tail.priority:
+        head.right = _merge(head.right, tail)
+        _update(head)
+        return head
+    tail.left = _merge(head, tail.left)
+    _update(tail)
+    return tail
+
+
+def _build(tracks):
+    # Balanced tree in O(n); priorities are handed out in breadth-first order
+    # from a sorted random sample, so every parent outranks its children
+    if not tracks:
+        return None
+    def build(lo, hi):
+        if lo >= hi:
+            return None
+        mid = (lo + hi) // 2
+        node = _Node(tracks[mid], 0.0)
+        node.left = build(lo, mid)
+        node.right = build(mid + 1, hi)
+        _update(node)
+        return node
+
+    root = build(0, len(tracks))
+    priorities = sorted((random.random() for _ in tracks), reverse=True)
+    level = [root]
+    idx = 0
+    while level:
+        following = []
+        for node in level:
+            node.priority = priorities[idx]
+            idx += 1
+            if node.left is not None:
+                following.append(node.left)
+            if node.right is not None:
+                following.append(node.right)
+        level = following
+    return root
+
+
+class TrackQueue:
+    # Implicit treap: a sequence where positional insert, remove, move and
+    # splitting off the front all take O(log n). Supports the deque operations
+    # the player uses, so it drops in for collections.deque.
+    def __init__(self, tracks=()):
+        self._root = _build(list(tracks))
+
+    def __len__(self):
+        return _size(self._root)
+
+    def __bool__(self):
+        return self._root is not None
+
+    def __iter__(self):
+        stack = []
+        node = self._root
+        while stack or node is not None:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield node.track
+            node = node.right
+
+    def _index(self, idx):
+        size = len(self)
+        if idx < 0:
+            idx += size
+        if not 0 <= idx < size:
+            raise IndexError("queue index out of range")
+        return idx
+
+    def __getitem__(self, idx):
+        idx = self._index(idx)
+        node = self._root
+        while True:
+            left = _size(node.left)
+            if idx < left:
+                node = node.left
+            elif idx == left:
+                return node.track
+            else:
+                idx -= left + 1
+                node = node.right
+
+    def insert(self, idx, track):
+        idx = max(0, min(idx, len(self)))
+        head, tail = _split(self._root, idx)
+        self._root = _merge(_merge(head, _Node(track, random.random())), tail)
+
+    def append(self, track):
+        self._root = _merge(self._root, _Node(track, random.random()))
+
+    def appendleft(self, track):
+        self._root = _merge(_Node(track, random.random()), self._root)
+
+    def extend(self, tracks):
+        self._root = _merge(self._root, _build(list(tracks)))
+
+    def pop(self, idx=-1):
+        idx = self._index(idx)
+        head, rest = _split(self._root, idx)
+        node, tail = _split(rest, 1)
+        self._root = _merge(head, tail)
+        return node.track
+
+    def popleft(self):
+        return self.pop(0)
+
+    def move(self, src, dst):
+        self.insert(dst, self.pop(src))
+
+    def take_front(self, count):
+        # Detaches the first `count` entries and returns them as their own queue
+        taken = TrackQueue()
+        taken._root, self._root = _split(self._root, count)
+        return taken
+
+    def extend_queue(self, other):
+        # Appends another queue's entries in O(log n), leaving it empty
+        self._root = _merge(self._root, other._root)
+        other._root = None
+
+    def shuffle(self):
+        # Shuffling touches every entry, so this one is O(n)
+        tracks = list(self)
+        random.shuffle(tracks)
+        self._root = _build(tracks)
+
+    def clear(self):
+        self._root = None
@@ -0,0 +1,290 @@
+import os
+import sys
+import time
+import secrets
+import logging
+import threading
+import itertools
+import subprocess
+from collections import deque
+from multiprocessing.connection import Client, Listener
+import discord
+from audio import CREATE_NO_WINDOW
+
+# Control protocol: (op, stream_id, payload) tuples over a local, authenticated
+# multiprocessing connection.
+#   front end -> worker  ("open", id, (spec, credit)), ("credit", id, frames), ("close", id, None)
+#   worker -> front end  ("frames", id, [packet, ...]), ("end", id, error or None)
+# A worker never sends more frames than it was granted credit for, so a stream
+# is buffered at most INITIAL_CREDIT frames ahead of playback.
+INITIAL_CREDIT = 150  # Frames (3 s) a worker may send ahead of playback
+FRAME_BATCH = 10  # Frames per message
+STALL_TIMEOUT = 10  # Seconds a stream may go without frames before the track is ended
+RESTART_DELAY = 1  # Seconds before a crashed worker is started again
+AUTHKEY_ENV = "VOICE_WORKER_AUTHKEY"
+
+
+def open_source(spec):
+    # The expensive part of playback: FFmpeg, its pipe and the Ogg demuxer
+    return discord.FFmpegOpusAudio(
+        spec["source"],
+        codec=spec.get("codec"),
+        before_options=spec.get("before_options"),
+        options=spec.get("options"),
+        executable=spec["executable"]
+    )
+
+
+# Worker process side
+class _WorkerStream:
+    def __init__(self, stream_id, spec, credit, send):
+        self.stream_id = stream_id
+        self.spec = spec
+        self._credit = credit
+        self._closed = False
+        self._cond = threading.Condition()
+        self._send = send
+        self._thread = threading.Thread(target=self._run, name=f"stream-{stream_id}", daemon=True)
+        self._thread.start()
+
+    def grant(self, frames):
+        with self._cond:
+            self._credit += frames
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def _run(self):
+        error = None
+        source = None
+        try:
+            source = open_source(self.spec)
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._credit > 0 or self._closed)
+                    if self._closed:
+                        return
+                    count = min(self._credit, FRAME_BATCH)
+                packets = []
+                for _ in range(count):
+                    packet = source.read()
+                    if not packet:
+                        break
+                    packets.append(packet)
+                with self._cond:
+                    self._credit -= len(packets)
+                if packets:
+                    self._send(("frames", self.stream_id, packets))
+                if len(packets) < count:
+                    break
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            if source is not None:
+                source.cleanup()
+        self._send(("end", self.stream_id, error))
+
+
+def worker_main(authkey):
+    listener = Listener(("127.0.0.1", 0), authkey=authkey)
+    host, port = listener.address
+    # The front end reads the address from the first line of stdout
+    print(host, port, flush=True)
+    sys.stdout = sys.stderr
+    conn = listener.accept()
+    listener.close()
+    lock = threading.Lock()
+
+    def send(message):
+        try:
+            with lock:
+                conn.send(message)
+        except OSError:
+            pass  # Front end is gone; the receive loop below exits on its own
+
+    streams = {}
+    try:
+        while True:
+            op, stream_id, payload = conn.recv()
+            if op == "open":
+                spec, credit = payload
+                streams[stream_id] = _WorkerStream(stream_id, spec, credit, send)
+            elif op == "credit":
+                stream = streams.get(stream_id)
+                if stream is not None:
+                    stream.grant(payload)
+            elif op == "close":
+                stream = streams.pop(stream_id, None)
+                if stream is not None:
+                    stream.close()
+    except (EOFError, OSError):
+        pass
+    finally:
+        for stream in streams.values():
+            stream.close()
+
+
+# Front end side
+class RemoteOpusAudio(discord.AudioSource):
+    # Plays Opus packets produced by a voice worker. read() runs on the voice
+    # client's player thread, so a stalled worker holds up this one track, never
+    # the event loop.
+    def __init__(self, worker, stream_id):
+        self._worker = worker
+        self.stream_id = stream_id
+        self._frames = deque()
+        self._cond = threading.Condition()
+        self._ended = False
+        self._consumed = 0
+        self.error = None
+
+    def _feed(self, packets):
+        with self._cond:
+            self._frames.extend(packets)
+            self._cond.notify()
+
+    def _end(self, error):
+        with self._cond:
+            self._ended = True
+            self.error = error
+            self._cond.notify()
+
+    def read(self):
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._frames or self._ended, timeout=STALL_TIMEOUT):
+                logging.error(f"Voice worker stream {self.stream_id} stalled, ending track")
+                return b""
+            if not self._frames:
+                if self.error:
+                    logging.error(f"Voice worker stream {self.stream_id} failed: {self.error}")
+                return b""
+            packet = self._frames.popleft()
+        self._consumed += 1
+        if self._consumed >= INITIAL_CREDIT // 2:
+            self._worker.send(("credit", self.stream_id, self._consumed))
+            self._consumed = 0
+        return packet
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self._worker.close_stream(self)
+
+
+class VoiceWorker:
+    # Handle on one worker process. A receive thread routes frames to their
+    # streams and restarts the process if it dies.
+    def __init__(self, name):
+        self.name = name
+        self.streams = {}
+        self.process = None
+        self._conn = None
+        self._send_lock = threading.Lock()
+        self._stopping = False
+
+    @property
+    def alive(self):
+        return self._conn is not None and self.process.poll() is None
+
+    def start(self):
+        authkey = secrets.token_bytes(32)
+        env = dict(os.environ, **{AUTHKEY_ENV: authkey.hex()})
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__)], stdout=subprocess.PIPE,
+                                        env=env, creationflags=CREATE_NO_WINDOW)
+        line = self.process.stdout.readline()
+        self.process.stdout.close()
+        if not line:
+            raise RuntimeError(f"{self.name} exited during startup")
+        host, port = line.decode().split()
+        self._conn = Client((host, int(port)), authkey=authkey)
+        threading.Thread(target=self._receive, name=f"{self.name}-recv", daemon=True).start()
+        logging.info(f"Started {self.name} (pid {self.process.pid})")
+
+    def _receive(self):
+        try:
+            while True:
+                op, stream_id, payload = self._conn.recv()
+                stream = self.streams.get(stream_id)
+                if stream is None:
+                    continue
+                if op == "frames":
+                    stream._feed(payload)
+                elif op == "end":
+                    stream._end(payload)
+        except (EOFError, OSError):
+            pass
+        self._conn = None
+        for stream in list(self.streams.values()):
+            stream._end(f"{self.name} exited")
+        if self._stopping:
+            return
+        logging.error(f"{self.name} exited unexpectedly, restarting")
+        self.process.kill()
+        self.process.wait()
+        time.sleep(RESTART_DELAY)
+        try:
+            self.start()
+        except (OSError, RuntimeError) as e:
+            logging.error(f"Failed to restart {self.name}: {str(e)}")
+
+    def send(self, message):
+        conn = self._conn
+        if conn is None:
+            return
+        try:
+            with self._send_lock:
+                conn.send(message)
+        except OSError:
+            pass  # The receive thread notices the dead connection and ends the streams
+
+    def open_stream(self, stream_id, spec):
+        stream = RemoteOpusAudio(self, stream_id)
+        self.streams[stream_id] = stream
+        self.send(("open", stream_id, (spec, INITIAL_CREDIT)))
+        return stream
+
+    def close_stream(self, stream):
+        if self.streams.pop(stream.stream_id, None) is not None:
+            self.send(("close", stream.stream_id, None))
+
+    def stop(self):
+        self._stopping = True
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            conn.close()
+        if self.process is not None:
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+class VoiceWorkerPool:
+    # Spreads FFmpeg streams over worker processes, each stream going to the
+    # live worker with the fewest open streams
+    def __init__(self, size):
+        self.workers = [VoiceWorker(f"voice-worker-{idx}") for idx in range(size)]
+        self._ids = itertools.count(1)
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def open_stream(self, spec):
+        live = [worker for worker in self.workers if worker.alive]
+        if not live:
+            return None
+        worker = min(live, key=lambda w: len(w.streams))
+        return worker.open_stream(next(self._ids), spec)
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+
+if __name__ == "__main__":
+    worker_main(bytes.fromhex(os.environ.pop(AUTHKEY_ENV)))